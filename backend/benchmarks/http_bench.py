@@ -0,0 +1,238 @@
+"""
+Latency / throughput benchmark for the backend HTTP API.
+
+Measures p50/p99 latency and requests per second for /health, every
+DiagramVariantEnum and synthetic diagrams from 1 KB to 50 MB, and writes
+the results as JSON. Runs the FastAPI app in-process by default, or
+against a running server with --url.
+
+    uv run python benchmarks/http_bench.py --output bench.json
+    uv run python benchmarks/http_bench.py --url http://127.0.0.1:8000 --output bench.json
+    uv run python benchmarks/http_bench.py --compare baseline.json --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from synthetic import synthetic_of_size
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+DEFAULT_SIZES = ["1KB", "10KB", "100KB", "1MB", "10MB", "50MB"]
+_UNITS = {"KB": 1024, "MB": 1024 ** 2, "B": 1}
+# Metrics where a larger value is a regression
+_LOWER_IS_BETTER = ("p50_ms", "p99_ms")
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    for unit, factor in _UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def measure(client: httpx.AsyncClient, path: str, requests: int, concurrency: int,
+                  headers: dict[str, str]) -> dict:
+    latencies: list[float] = []
+    received = 0  # bytes on the wire, before Content-Encoding is undone
+    decoded = 0
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal received, decoded, errors
+        for _ in pending:
+            start = time.perf_counter()
+            response = await client.get(path, headers=headers)
+            body = await response.aread()
+            latencies.append(time.perf_counter() - start)
+            received += response.num_bytes_downloaded
+            decoded += len(body)
+            if response.status_code >= 400:
+                errors += 1
+
+    # Warm-up request, not counted
+    await client.get(path, headers=headers)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, requests))))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "path": path,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "rps": requests / elapsed,
+        "bytes_per_request": received / requests,
+        "decoded_bytes_per_request": decoded / requests,
+    }
+
+
+@asynccontextmanager
+async def in_process_client(storage_dir: Path) -> AsyncIterator[httpx.AsyncClient]:
+    """
+    Runs the app (including its lifespan) inside this interpreter on a copy of data/.
+    """
+    os.environ["STORAGE_URL"] = "file:" + str(storage_dir)
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            yield client
+
+
+@asynccontextmanager
+async def remote_client(url: str) -> AsyncIterator[httpx.AsyncClient]:
+    limits = httpx.Limits(max_connections=256, max_keepalive_connections=256)
+    async with httpx.AsyncClient(base_url=url, timeout=None, limits=limits) as client:
+        yield client
+
+
+def requests_for(size: int, requests: int) -> int:
+    # Keep multi-megabyte targets from dominating the run time
+    return max(10, min(requests, requests * 1024 ** 2 // max(size, 1)))
+
+
+async def run(args) -> dict:
+    from schemas import DiagramVariantEnum
+
+    headers = {"Accept-Encoding": args.accept_encoding}
+    targets: list[tuple[str, str, int]] = [("health", "/health", args.requests)]
+    targets += [("variant:%s" % v.value, "/api/v1/diagram?variant=%s" % v.value, args.requests)
+                for v in DiagramVariantEnum]
+
+    with tempfile.TemporaryDirectory(prefix="idef0-bench-") as tmp:
+        storage_dir = Path(tmp)
+        for fixture in (BACKEND_DIR / "data").glob("*.xml"):
+            shutil.copy(fixture, storage_dir)
+
+        context = remote_client(args.url) if args.url else in_process_client(storage_dir)
+        async with context as client:
+            for label in args.sizes:
+                size = parse_size(label)
+                name = "bench-synthetic-%s" % label.lower()
+                response = await client.put("/api/v1/diagrams/%s" % name, content=synthetic_of_size(size))
+                response.raise_for_status()
+                targets.append(("synthetic:%s" % label, "/api/v1/diagrams/%s" % name,
+                                requests_for(size, args.requests)))
+
+            results = {}
+            for key, path, requests in targets:
+                results[key] = await measure(client, path, requests, args.concurrency, headers)
+                print("%-22s p50 %9.3f ms  p99 %9.3f ms  %10.1f req/s  %10.0f B/req" % (
+                    key, results[key]["p50_ms"], results[key]["p99_ms"], results[key]["rps"],
+                    results[key]["bytes_per_request"]), file=sys.stderr)
+
+            if args.url:
+                for label in args.sizes:
+                    await client.delete("/api/v1/diagrams/bench-synthetic-%s" % label.lower())
+
+    return {"meta": environment(args), "results": results}
+
+
+def environment(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=BACKEND_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mode": "remote" if args.url else "in-process",
+        "url": args.url,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "accept_encoding": args.accept_encoding,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns a line for every metric that regressed by more than ``threshold``.
+    Any increase in errors is a regression: failing endpoints usually get faster.
+    """
+    regressions = []
+    for key, now in current["results"].items():
+        before = baseline["results"].get(key)
+        if before is None:
+            continue
+        if now["errors"] > before["errors"]:
+            regressions.append("%s errors: %d -> %d" % (key, before["errors"], now["errors"]))
+        for metric in (*_LOWER_IS_BETTER, "rps"):
+            old, new = before[metric], now[metric]
+            if old <= 0:
+                continue
+            change = (new - old) / old
+            worse = change > threshold if metric in _LOWER_IS_BETTER else change < -threshold
+            if worse:
+                regressions.append("%s %s: %.3f -> %.3f (%+.1f%%)" % (key, metric, old, new, change * 100))
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--requests", type=int, default=500, help="requests per target (scaled down above 1 MB)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--sizes", nargs="*", default=DEFAULT_SIZES, help="synthetic diagram sizes, e.g. 1KB 5MB")
+    parser.add_argument("--accept-encoding", default="gzip, br")
+    parser.add_argument("--output", help="write JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="flag regressions against a stored result file")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(result, baseline, args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line, file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions beyond %.0f%%" % (args.threshold * 100), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Parse time / peak RSS of mxgraph.parse on synthetic diagrams.
+
+Every size is parsed in a fresh interpreter so ru_maxrss reflects that size only.
+
+    uv run python benchmarks/mxgraph_scaling.py --sizes 1000 10000 50000 100000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from synthetic import iter_synthetic
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+
+def write_synthetic(path: Path, cells: int) -> None:
+    with path.open("w", encoding="utf-8") as fp:
+        fp.writelines(iter_synthetic(cells))
+
+
+def measure(path: str) -> dict:
+    """
+    Runs inside the child interpreter.
+    """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    import mxgraph
+    start = time.perf_counter()
+    mxfile = mxgraph.parse(path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "cells": sum(len(d.cells) for d in mxfile.diagrams),
+        "parse_seconds": elapsed,
+        "peak_rss_kb": peak,
+        "rss_growth_kb": peak - baseline,
+    }
+
+
+def run(sizes: list[int]) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = Path(tmp) / f"synthetic_{size}.xml"
+            write_synthetic(path, size)
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", str(path)],
+                check=True, capture_output=True, text=True, cwd=BACKEND_DIR,
+            )
+            result = json.loads(out.stdout)
+            result["file_bytes"] = os.path.getsize(path)
+            results.append(result)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000, 100_000])
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return
+
+    results = run(sorted(args.sizes))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("%10s %12s %10s %12s %14s %14s" % ("cells", "file MB", "parse s", "RSS +MB", "us / cell", "bytes / cell"))
+    for r in results:
+        print("%10d %12.2f %10.3f %12.1f %14.2f %14.0f" % (
+            r["cells"], r["file_bytes"] / 2**20, r["parse_seconds"], r["rss_growth_kb"] / 1024,
+            r["parse_seconds"] / r["cells"] * 1e6, r["rss_growth_kb"] * 1024 / r["cells"],
+        ))
+
+
+if __name__ == "__main__":
+    main()
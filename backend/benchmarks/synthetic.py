@@ -0,0 +1,36 @@
+"""
+Synthetic drawio documents for benchmarks.
+"""
+from typing import Iterator
+
+HEADER = ('<mxfile host="benchmark"><diagram id="bench" name="Страница-1">'
+          '<mxGraphModel dx="800" dy="450" grid="1" gridSize="10"><root>\n'
+          '<mxCell id="0" />\n<mxCell id="1" parent="0" />\n')
+FOOTER = "</root></mxGraphModel></diagram></mxfile>\n"
+# Average encoded size of one generated cell, used to hit a target file size
+BYTES_PER_CELL = 198
+
+
+def iter_synthetic(cells: int) -> Iterator[str]:
+    """
+    Roughly half vertices, half edges chaining consecutive vertices.
+    """
+    yield HEADER
+    vertices = max(cells // 2, 1)
+    for i in range(vertices):
+        yield ('<mxCell id="v%d" value="Блок %d" style="rounded=0;whiteSpace=wrap;html=1;" parent="1" vertex="1">'
+               '<mxGeometry x="%d" y="%d" width="120" height="60" as="geometry" /></mxCell>\n'
+               % (i, i, (i % 100) * 160, (i // 100) * 100))
+    for i in range(cells - vertices):
+        yield ('<mxCell id="e%d" value="Стрелка %d" style="edgeStyle=orthogonalEdgeStyle;rounded=0;html=1;" '
+               'parent="1" edge="1" source="v%d" target="v%d"><mxGeometry relative="1" as="geometry" /></mxCell>\n'
+               % (i, i, i % vertices, (i + 1) % vertices))
+    yield FOOTER
+
+
+def synthetic_of_size(size: int) -> bytes:
+    """
+    A document of approximately ``size`` bytes.
+    """
+    cells = max((size - len(HEADER) - len(FOOTER)) // BYTES_PER_CELL, 1)
+    return "".join(iter_synthetic(cells)).encode("utf-8")
@@ -2,7 +2,22 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
 class Settings(BaseSettings):
-    DATA_DIR: str = r"data"     
+    STORAGE_URL: str = r"file:data"  # or file:data?compression=gzip, sqlite:///diagrams.db
+    STORAGE_POOL_SIZE: int = 4  # SQLite connections
+    CACHE_MAX_BYTES: int = 8 * 1024 * 1024  # larger diagrams are streamed from storage
+    CACHE_TOTAL_BYTES: int = 128 * 1024 * 1024  # raw + compressed bodies of all cached diagrams
+    CACHE_POLL_INTERVAL: float = 2.0  # seconds between storage change scans
+    PATCH_HISTORY_LIMIT: int = 10000  # cell changes kept per diagram for diffs
+    PATCH_DOCUMENTS_LIMIT: int = 64  # edited diagrams kept in memory
+    PATCH_FLUSH_DELAY: float = 1.0  # seconds from a patch to writing the diagram back
+    LAYOUT_CACHE_SIZE: int = 256  # rendered IDEF0 pages kept by the layout memo
+    EXPORT_WORKERS: int = 0  # export process pool size, 0 = CPU count
+    EXPORT_MAX_BATCH: int = 10000  # diagrams per export request
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json"  # or "text"
+    PROFILER_ALLOWED: bool = False  # exposes the /debug/profiler endpoints
+    PROFILER_INTERVAL_MS: float = 5.0
+    PROFILER_SLOW_MS: float = 250.0  # requests slower than this keep their samples
     model_config = SettingsConfigDict(env_file=".env", env_ignore_empty=True)
 
 _settings: Optional[Settings] = None
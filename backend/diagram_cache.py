@@ -0,0 +1,230 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Iterable, Optional
+
+from config import get_settings
+from storage import DiagramInfo, DiagramRepository, get_repository
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def not_modified_since(mtime_ns: int, if_modified_since: str) -> bool:
+    """
+    Whether a diagram modified at ``mtime_ns`` is unchanged since an
+    If-Modified-Since date (compared at the header's one second resolution).
+    """
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return mtime_ns // 1_000_000_000 <= since
+
+
+@dataclass(frozen=True, slots=True)
+class CachedDiagram:
+    """
+    One diagram file held in memory together with its precompressed bodies.
+    """
+    filename: str
+    raw: bytes
+    mtime_ns: int
+    etag: str
+    last_modified: str
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    def etag_for(self, encoding: Optional[str]) -> str:
+        # Every representation gets its own strong validator
+        if encoding is None:
+            return self.etag
+        return '%s-%s"' % (self.etag[:-1], encoding)
+
+    def matches(self, if_none_match: str) -> bool:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in tags:
+            return True
+        return any(self.etag_for(enc) in tags for enc in (None, *self.encoded))
+
+    def not_modified_since(self, if_modified_since: str) -> bool:
+        return not_modified_since(self.mtime_ns, if_modified_since)
+
+    def select(self, accept_encoding: str) -> tuple[bytes, Optional[str]]:
+        """
+        Picks the smallest body the client accepts, falling back to the raw bytes.
+        """
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and encoding in accepted:
+                return self.encoded[encoding], encoding
+        return self.raw, None
+
+
+def parse_accept_encoding(header: str) -> set[str]:
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.lower())
+    return accepted
+
+
+def _build_entry(filename: str, raw: bytes, mtime_ns: int) -> CachedDiagram:
+    encoded = {}
+    gz = gzip.compress(raw, compresslevel=9, mtime=0)
+    if len(gz) < len(raw):
+        encoded["gzip"] = gz
+    if brotli is not None:
+        br = brotli.compress(raw, quality=11)
+        if len(br) < len(raw):
+            encoded["br"] = br
+
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    return CachedDiagram(
+        filename=filename,
+        raw=raw,
+        mtime_ns=mtime_ns,
+        etag='"%s"' % digest,
+        last_modified=formatdate(mtime_ns / 1_000_000_000, usegmt=True),
+        encoded=encoded,
+    )
+
+
+def _weight(entry: CachedDiagram) -> int:
+    return len(entry.raw) + sum(len(body) for body in entry.encoded.values())
+
+
+class DiagramCache:
+    """
+    In-memory store of the diagrams kept in the storage repository.
+    Diagrams are read and compressed once; a background task re-lists the
+    repository and reloads entries whose modification time or size changed.
+    Entries are evicted least recently used first once all bodies together
+    exceed ``total_bytes``; warmed diagrams are pinned and never evicted.
+    """
+
+    def __init__(self, repository: DiagramRepository, max_bytes: int, total_bytes: int):
+        self.repository = repository
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self._entries: OrderedDict[str, CachedDiagram] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._pinned: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, name: str) -> Optional[CachedDiagram]:
+        entry = self._entries.get(name)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(name)
+        return entry
+
+    async def load(self, name: str) -> Optional[CachedDiagram]:
+        """
+        Returns the cached entry, reading it from the repository on a miss.
+        None if the diagram does not exist or is larger than ``max_bytes``.
+        """
+        entry = self.get(name)
+        if entry is not None:
+            return entry
+        return await self.reload(name)
+
+    async def reload(self, name: str) -> Optional[CachedDiagram]:
+        stored = await self.repository.get(name)
+        if stored is None:
+            self.invalidate(name)
+            return None
+        if len(stored.data) > self.max_bytes:
+            # Large diagrams are streamed from storage instead of held in memory
+            self.invalidate(name)
+            logger.info("Diagram %s (%d bytes) is too large to cache", name, len(stored.data))
+            return None
+
+        entry = await asyncio.to_thread(_build_entry, f"{name}.xml", stored.data, stored.modified_ns)
+        self.invalidate(name)
+        self._entries[name] = entry
+        self._sizes[name] = len(stored.data)
+        self.bytes += _weight(entry)
+        self._evict()
+        logger.info("Cached diagram %s (%d bytes, encodings: %s)",
+                    name, len(stored.data), ",".join(entry.encoded) or "none")
+        return entry
+
+    async def warm(self, names: Iterable[str]) -> None:
+        for name in names:
+            self._pinned.add(name)
+            if await self.reload(name) is None:
+                logger.warning("Diagram %s not cached (missing or too large)", name)
+
+    async def refresh(self, infos: Optional[list[DiagramInfo]] = None) -> list[str]:
+        """
+        Reloads entries changed or removed according to ``infos``, a listing
+        of the repository (taken here when not given). Returns the names of
+        invalidated entries.
+        """
+        if infos is None:
+            infos = await self.repository.list()
+        seen = {info.name: (info.modified_ns, info.size) for info in infos}
+
+        changed = []
+        for name, entry in list(self._entries.items()):
+            state = seen.get(name)
+            if state == (entry.mtime_ns, self._sizes.get(name)):
+                continue
+            changed.append(name)
+            if state is None:
+                self.invalidate(name)
+            else:
+                await self.reload(name)
+        if changed:
+            logger.info("Invalidated cached diagrams: %s", ", ".join(changed))
+        return changed
+
+    def invalidate(self, name: str) -> None:
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self.bytes -= _weight(entry)
+        self._sizes.pop(name, None)
+
+    def _evict(self) -> None:
+        if self.bytes <= self.total_bytes:
+            return
+        for name in [name for name in self._entries if name not in self._pinned]:
+            self.invalidate(name)
+            self.evictions += 1
+            if self.bytes <= self.total_bytes:
+                break
+
+
+_diagram_cache: Optional[DiagramCache] = None
+
+def get_diagram_cache() -> DiagramCache:
+    global _diagram_cache
+    if _diagram_cache is None:
+        settings = get_settings()
+        _diagram_cache = DiagramCache(get_repository(), settings.CACHE_MAX_BYTES, settings.CACHE_TOTAL_BYTES)
+    return _diagram_cache
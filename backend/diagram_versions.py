@@ -0,0 +1,438 @@
+"""
+Versioned diagram documents edited through cell-level patches.
+
+Every applied change bumps the document version and is appended to a change
+log of (version, cell key) pairs, so both applying a patch and computing the
+diff since a client's version cost O(changed cells), not O(document).
+
+Edited documents are written back to storage shortly after their first
+unsaved patch (write-behind). Each loaded document has an epoch, a hash of
+the content it was loaded from; clients hold (epoch, version), so once the
+stored diagram is replaced and reloaded their old versions are refused.
+"""
+import asyncio
+import hashlib
+import logging
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import mxgraph
+from config import get_settings
+from schemas import CellOpEnum, SCellChange, SDiagramDiff, SGeometry, SPoint
+from storage import DiagramInfo, DiagramRepository, get_repository
+
+
+logger = logging.getLogger(__name__)
+
+CellKey = tuple[Optional[str], str]  # (page id, cell id)
+_REFERENCES = ("parent", "source", "target")  # cell fields naming another cell of the same page
+
+
+class PatchError(ValueError):
+    pass
+
+
+class VersionTooOld(LookupError):
+    """
+    The requested version is older than the retained change log or belongs to
+    a replaced document; the client has to reload.
+    """
+
+
+def _point(point: Optional[SPoint]) -> Optional[mxgraph.MxPoint]:
+    return None if point is None else mxgraph.MxPoint(point.x, point.y)
+
+
+def _spoint(point: Optional[mxgraph.MxPoint]) -> Optional[SPoint]:
+    return None if point is None else SPoint(x=point.x, y=point.y)
+
+
+def _apply_geometry(geo: Optional[mxgraph.MxGeometry], change: SGeometry) -> mxgraph.MxGeometry:
+    if geo is None:
+        geo = mxgraph.MxGeometry()
+    for name in change.model_fields_set:
+        if name == "points":
+            geo.points = None if change.points is None else [_point(p) for p in change.points]
+        elif name in ("source_point", "target_point"):
+            setattr(geo, name, _point(getattr(change, name)))
+        else:
+            setattr(geo, name, getattr(change, name))
+    return geo
+
+
+def _cell_change(op: CellOpEnum, page: Optional[str], cell: mxgraph.MxCell) -> SCellChange:
+    geo = cell.geometry
+    return SCellChange(
+        op=op, id=cell.id, page=page, parent=cell.parent, value=cell.value,
+        style=mxgraph.format_style(cell.style), vertex=cell.vertex, edge=cell.edge,
+        source=cell.source, target=cell.target,
+        geometry=None if geo is None else SGeometry(
+            x=geo.x, y=geo.y, width=geo.width, height=geo.height, relative=geo.relative,
+            points=None if geo.points is None else [_spoint(p) for p in geo.points],
+            source_point=_spoint(geo.source_point), target_point=_spoint(geo.target_point),
+        ),
+    )
+
+
+class VersionedDiagram:
+
+    def __init__(self, document: mxgraph.MxFile, history_limit: int, epoch: str = ""):
+        if not document.diagrams:
+            raise PatchError("Document has no pages")
+        self.document = document
+        self.epoch = epoch
+        self.version = 0
+        self.history_limit = history_limit
+        # Oldest version a diff can still be computed from
+        self.floor = 0
+        self._pages = {diagram.id: diagram for diagram in document.diagrams}
+        self._default_page = document.diagrams[0].id
+        self._log_versions: list[int] = []
+        self._log_keys: list[CellKey] = []
+        # Version at which cells added through patches were created; absent means "in the original file"
+        self._created: dict[CellKey, int] = {}
+        # Cells naming each cell as parent, source or target, so removals are checked without a page scan
+        self._referrers: dict[CellKey, set[str]] = {}
+        for diagram in document.diagrams:
+            for cell in diagram.cells.values():
+                self._link(diagram.id, cell, True)
+        # Maintained by DiagramVersions: last version written to storage and
+        # the (mtime, size) states storage had while this document was current
+        self.saved_version = 0
+        self.stored_states: deque[tuple[int, int]] = deque(maxlen=4)
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.saved_version
+
+    def _page(self, page: Optional[str]) -> tuple[Optional[str], mxgraph.MxDiagram]:
+        page_id = self._default_page if page is None else page
+        try:
+            return page_id, self._pages[page_id]
+        except KeyError:
+            raise PatchError("Unknown page %r" % page) from None
+
+    def _link(self, page_id: Optional[str], cell: mxgraph.MxCell, linked: bool) -> None:
+        for name in _REFERENCES:
+            other = getattr(cell, name)
+            if other is None:
+                continue
+            key = (page_id, other)
+            if linked:
+                self._referrers.setdefault(key, set()).add(cell.id)
+            elif key in self._referrers:
+                self._referrers[key].discard(cell.id)
+                if not self._referrers[key]:
+                    del self._referrers[key]
+
+    def _validate(self, changes: list[SCellChange]) -> None:
+        # Checked up front so a rejected patch leaves the document untouched
+        pending: dict[CellKey, bool] = {}
+        references: dict[CellKey, dict[str, Optional[str]]] = {}  # reference fields set by the patch
+        for change in changes:
+            page_id, diagram = self._page(change.page)
+            key = (page_id, change.id)
+            exists = pending.get(key, change.id in diagram.cells)
+            if change.op == CellOpEnum.add and exists:
+                raise PatchError("Cell %r already exists" % change.id)
+            if change.op != CellOpEnum.add and not exists:
+                raise PatchError("Cell %r does not exist" % change.id)
+            pending[key] = change.op != CellOpEnum.remove
+            if change.op == CellOpEnum.remove:
+                references.pop(key, None)
+                continue
+            if change.op == CellOpEnum.add:
+                references[key] = dict.fromkeys(_REFERENCES)
+            references.setdefault(key, {}).update(
+                (name, getattr(change, name)) for name in _REFERENCES if name in change.model_fields_set)
+
+        def alive(page_id: Optional[str], cell_id: str) -> bool:
+            return pending.get((page_id, cell_id), cell_id in self._pages[page_id].cells)
+
+        for (page_id, cell_id), fields in references.items():
+            for name, other in fields.items():
+                if other is not None and not alive(page_id, other):
+                    raise PatchError("Cell %r: %s %r does not exist" % (cell_id, name, other))
+        # Removed cells must not be left referenced by the cells that stay
+        for (page_id, cell_id), exists in pending.items():
+            if exists:
+                continue
+            for referrer in self._referrers.get((page_id, cell_id), ()):
+                if not alive(page_id, referrer):
+                    continue
+                fields = references.get((page_id, referrer), {})
+                cell = self._pages[page_id].cells[referrer]
+                if any(fields.get(name, getattr(cell, name)) == cell_id for name in _REFERENCES):
+                    raise PatchError("Cell %r is still referenced by cell %r" % (cell_id, referrer))
+
+    def check_base(self, epoch: str, version: int) -> None:
+        """
+        Raises VersionTooOld unless a client at (``epoch``, ``version``) can
+        still be brought up to date with a diff.
+        """
+        if epoch != self.epoch:
+            raise VersionTooOld("Diagram was replaced (epoch %s, expected %s)" % (epoch, self.epoch))
+        if version < self.floor or version > self.version:
+            raise VersionTooOld("Version %d is not available (history covers %d..%d)"
+                                % (version, self.floor, self.version))
+
+    def apply(self, changes: list[SCellChange], keep: Optional[int] = None) -> int:
+        """
+        Applies a patch atomically and returns the new version. The change
+        log is not trimmed past ``keep``, so a diff from it stays available.
+        """
+        self._validate(changes)
+        if not changes:
+            return self.version
+
+        self.version += 1
+        for change in changes:
+            page_id, diagram = self._page(change.page)
+            key = (page_id, change.id)
+            if change.op == CellOpEnum.remove:
+                self._link(page_id, diagram.cells.pop(change.id), False)
+            elif change.op == CellOpEnum.add:
+                cell = mxgraph.MxCell(change.id)
+                diagram.add(cell)
+                self._created[key] = self.version
+                self._update(cell, change, change.model_fields_set)
+                self._link(page_id, cell, True)
+            else:
+                cell = diagram.cells[change.id]
+                self._link(page_id, cell, False)
+                self._update(cell, change, change.model_fields_set)
+                self._link(page_id, cell, True)
+            self._log_versions.append(self.version)
+            self._log_keys.append(key)
+
+        self._trim(keep)
+        return self.version
+
+    @staticmethod
+    def _update(cell: mxgraph.MxCell, change: SCellChange, fields: set[str]) -> None:
+        for name in fields:
+            if name in ("op", "id", "page"):
+                continue
+            if name == "style":
+                cell.style = mxgraph.parse_style(change.style)
+            elif name == "geometry":
+                cell.geometry = None if change.geometry is None else _apply_geometry(cell.geometry, change.geometry)
+            elif name in ("vertex", "edge"):
+                setattr(cell, name, bool(getattr(change, name)))
+            else:
+                setattr(cell, name, getattr(change, name))
+
+    def _trim(self, keep: Optional[int] = None) -> None:
+        overflow = len(self._log_versions) - self.history_limit
+        if overflow <= 0:
+            return
+        last = self._log_versions[overflow - 1]
+        if keep is not None:
+            last = min(last, keep)
+        # Never split a version: drop whole versions from the front
+        cut = bisect_right(self._log_versions, last)
+        if not cut:
+            return
+        self.floor = self._log_versions[cut - 1]
+        for key in self._log_keys[:cut]:
+            page_id, cell_id = key
+            if cell_id not in self._pages[page_id].cells:
+                self._created.pop(key, None)
+        del self._log_versions[:cut]
+        del self._log_keys[:cut]
+
+    def diff(self, since: int) -> SDiagramDiff:
+        """
+        Current state of every cell changed after ``since``.
+        """
+        if since < self.floor or since > self.version:
+            raise VersionTooOld("Version %d is not available (history covers %d..%d)"
+                                % (since, self.floor, self.version))
+
+        start = bisect_right(self._log_versions, since)
+        seen = set()
+        changes = []
+        for key in self._log_keys[start:]:
+            if key in seen:
+                continue
+            seen.add(key)
+            page_id, cell_id = key
+            cell = self._pages[page_id].cells.get(cell_id)
+            created_after = self._created.get(key, 0) > since
+            if cell is None:
+                if not created_after:
+                    changes.append(SCellChange(op=CellOpEnum.remove, id=cell_id, page=page_id))
+            else:
+                op = CellOpEnum.add if created_after else CellOpEnum.update
+                changes.append(_cell_change(op, page_id, cell))
+        return SDiagramDiff(epoch=self.epoch, version=self.version, since=since, changes=changes)
+
+    def to_xml(self) -> str:
+        return mxgraph.dumps(self.document)
+
+
+class DiagramVersions:
+    """
+    Registry of versioned documents, seeded from storage on first use and
+    written back ``flush_delay`` seconds after their first unsaved patch.
+    Beyond ``max_documents`` the least recently used saved documents are
+    dropped; they are reloaded, under a new epoch if edited, on next use.
+    """
+
+    def __init__(self, repository: DiagramRepository, history_limit: int,
+                 max_documents: int = 64, flush_delay: float = 1.0):
+        self.repository = repository
+        self.history_limit = history_limit
+        self.max_documents = max_documents
+        self.flush_delay = flush_delay
+        self._documents: OrderedDict[str, VersionedDiagram] = OrderedDict()
+        self._lock = asyncio.Lock()
+        self._flushes: dict[str, asyncio.Task] = {}
+        self._writing: dict[str, tuple[asyncio.Lock, int]] = {}  # name -> (lock, holders and waiters)
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    async def get(self, name: str) -> Optional[VersionedDiagram]:
+        document = self._documents.get(name)
+        if document is not None:
+            self._documents.move_to_end(name)
+            return document
+
+        async with self._lock:
+            document = self._documents.get(name)
+            if document is None:
+                stored = await self.repository.get(name)
+                if stored is None:
+                    return None
+                parsed = await asyncio.to_thread(mxgraph.parse, stored.data)
+                epoch = hashlib.sha256(stored.data).hexdigest()[:16]
+                document = self._documents[name] = VersionedDiagram(parsed, self.history_limit, epoch)
+                document.stored_states.append((stored.modified_ns, len(stored.data)))
+                self._evict()
+        return document
+
+    @asynccontextmanager
+    async def writing(self, name: str) -> AsyncIterator[None]:
+        """
+        Serializes writes of ``name`` to storage. Saves and deletes made
+        elsewhere hold it too, so a pending write-back cannot overwrite them.
+        """
+        lock, users = self._writing.get(name, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._writing[name] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._writing[name]
+            if users == 1:
+                del self._writing[name]
+            else:
+                self._writing[name] = (lock, users - 1)
+
+    def changed(self, name: str) -> None:
+        """
+        Schedules writing ``name`` back to storage after a patch.
+        """
+        if name not in self._flushes:
+            self._flushes[name] = asyncio.create_task(self._flush_later(name))
+
+    async def _flush_later(self, name: str) -> None:
+        await asyncio.sleep(self.flush_delay)
+        # From here on a new patch schedules another write
+        del self._flushes[name]
+        try:
+            await self.flush(name)
+        except Exception:
+            logger.exception("Cannot write back diagram %s", name)
+
+    async def flush(self, name: str) -> Optional[DiagramInfo]:
+        """
+        Writes an edited document to storage now.
+        """
+        async with self.writing(name):
+            document = self._documents.get(name)
+            if document is None or not document.dirty:
+                return None
+            version = document.version
+            # Serialized on the event loop, where patches modify the document
+            data = document.to_xml().encode("utf-8")
+            info = await self.repository.put(name, data)
+            document.saved_version = version
+            document.stored_states.append((info.modified_ns, info.size))
+        logger.info("Wrote back diagram %s at version %d", name, version)
+        self._evict()
+        return info
+
+    async def close(self) -> None:
+        """
+        Writes back every edited document; called on shutdown.
+        """
+        for task in self._flushes.values():
+            task.cancel()
+        self._flushes.clear()
+        for name in list(self._documents):
+            try:
+                await self.flush(name)
+            except Exception:
+                logger.exception("Cannot write back diagram %s", name)
+
+    def discard(self, name: str) -> None:
+        """
+        Forgets the document, including unsaved patches, after the stored
+        diagram was replaced or deleted.
+        """
+        task = self._flushes.pop(name, None)
+        if task is not None:
+            task.cancel()
+        self._documents.pop(name, None)
+
+    async def refresh(self, infos: list[DiagramInfo]) -> list[str]:
+        """
+        Discards documents whose stored diagram was changed or removed other
+        than through this registry, according to the listing ``infos``.
+        Returns their names.
+        """
+        seen = {info.name: (info.modified_ns, info.size) for info in infos}
+        changed = []
+        for name, document in list(self._documents.items()):
+            if name in self._writing:
+                # Being written: the listing may predate or race the write
+                continue
+            if seen.get(name) in document.stored_states:
+                if document.dirty and name not in self._flushes:
+                    # Retry a write-back that failed
+                    self.changed(name)
+                continue
+            changed.append(name)
+            self.discard(name)
+        if changed:
+            logger.info("Discarded edited diagrams changed in storage: %s", ", ".join(changed))
+        return changed
+
+    def _evict(self) -> None:
+        overflow = len(self._documents) - self.max_documents
+        # The most recently used document is the one being handed out
+        for name in list(self._documents)[:-1]:
+            if overflow <= 0:
+                break
+            # Unsaved documents stay until their write-back
+            if self._documents[name].dirty or name in self._writing:
+                continue
+            del self._documents[name]
+            overflow -= 1
+
+
+_diagram_versions: Optional[DiagramVersions] = None
+
+def get_diagram_versions() -> DiagramVersions:
+    global _diagram_versions
+    if _diagram_versions is None:
+        settings = get_settings()
+        _diagram_versions = DiagramVersions(get_repository(), settings.PATCH_HISTORY_LIMIT,
+                                            settings.PATCH_DOCUMENTS_LIMIT, settings.PATCH_FLUSH_DELAY)
+    return _diagram_versions
@@ -0,0 +1,403 @@
+"""
+Diagram format conversion and batch export.
+
+The converters are plain functions over bytes so they can run in worker
+processes; ``export_batch`` fans a list of stored diagrams out to a bounded
+process pool and yields zip or NDJSON chunks as conversions finish.
+
+CLI::
+
+    python export.py --format svg --output diagrams.zip simple complex
+    python export.py --format json --ndjson --all > cells.ndjson
+"""
+import argparse
+import asyncio
+import base64
+import html
+import json
+import multiprocessing
+import os
+import re
+import sys
+import zipfile
+import zlib
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from contextlib import aclosing
+from typing import AsyncIterator, Iterable, Optional
+
+import mxgraph
+from config import get_settings
+from schemas import ExportContainerEnum, ExportFormatEnum
+from storage import DiagramRepository, get_repository
+
+
+# Conversion, runs in worker processes
+
+_TAG = re.compile(r"<[^>]+>")
+_BREAK = re.compile(r"<br\s*/?>|</div>|</p>", re.IGNORECASE)
+
+
+def _text_lines(value: Optional[str], is_html: bool) -> list[str]:
+    if not value:
+        return []
+    if is_html:
+        value = html.unescape(_TAG.sub("", _BREAK.sub("\n", value)))
+    return [line for line in value.split("\n") if line.strip()]
+
+
+def _absolute_origins(diagram: mxgraph.MxDiagram) -> dict[str, tuple[float, float]]:
+    """
+    Child vertex geometry is relative to its parent vertex; resolve it once per cell.
+    """
+    origins: dict[str, tuple[float, float]] = {}
+
+    def origin(cell_id: Optional[str], depth: int = 0) -> tuple[float, float]:
+        if cell_id is None or depth > 64:
+            return 0.0, 0.0
+        if cell_id in origins:
+            return origins[cell_id]
+        cell = diagram.cells.get(cell_id)
+        if cell is None or not cell.vertex or cell.geometry is None:
+            result = (0.0, 0.0)
+        else:
+            px, py = origin(cell.parent, depth + 1)
+            result = (px + cell.geometry.x, py + cell.geometry.y)
+        origins[cell_id] = result
+        return result
+
+    for cell in diagram.cells.values():
+        origin(cell.id)
+    return origins
+
+
+def _terminal(cell: Optional[mxgraph.MxCell], origins, style: dict, prefix: str,
+              fallback: Optional[mxgraph.MxPoint]) -> Optional[tuple[float, float]]:
+    if cell is not None and cell.geometry is not None:
+        x, y = origins[cell.id]
+        fx = float(style.get(prefix + "X") or 0.5)
+        fy = float(style.get(prefix + "Y") or 0.5)
+        return x + fx * cell.geometry.width, y + fy * cell.geometry.height
+    if fallback is not None:
+        return fallback.x, fallback.y
+    return None
+
+
+def _orthogonal(points: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    # Approximates drawio's orthogonal router with a horizontal-vertical-horizontal elbow
+    result = [points[0]]
+    for bx, by in points[1:]:
+        ax, ay = result[-1]
+        if ax != bx and ay != by:
+            mid = (ax + bx) / 2
+            result += [(mid, ay), (mid, by)]
+        result.append((bx, by))
+    return result
+
+
+def _fmt(value: float) -> str:
+    return mxgraph.format_number(round(value, 2))
+
+
+def render_svg(diagram: mxgraph.MxDiagram) -> str:
+    """
+    Minimal static SVG rendering: rectangles / ellipses with labels and
+    polyline edges with arrowheads. Enough for previews and print exports.
+    """
+    origins = _absolute_origins(diagram)
+    shapes = []
+    edges = []
+    xs = [0.0]
+    ys = [0.0]
+
+    for cell in diagram.cells.values():
+        style = cell.style or {}
+        is_html = style.get("html") == "1"
+        geo = cell.geometry
+        if cell.vertex and geo is not None:
+            x, y = origins[cell.id]
+            xs += [x, x + geo.width]
+            ys += [y, y + geo.height]
+            fill = style.get("fillColor") or "#ffffff"
+            stroke = style.get("strokeColor") or "#000000"
+            if "text" not in style:
+                if "ellipse" in style:
+                    shapes.append('<ellipse cx="%s" cy="%s" rx="%s" ry="%s" fill="%s" stroke="%s" />' % (
+                        _fmt(x + geo.width / 2), _fmt(y + geo.height / 2), _fmt(geo.width / 2),
+                        _fmt(geo.height / 2), html.escape(fill), html.escape(stroke)))
+                else:
+                    radius = ' rx="6"' if style.get("rounded") == "1" else ""
+                    shapes.append('<rect x="%s" y="%s" width="%s" height="%s"%s fill="%s" stroke="%s" />' % (
+                        _fmt(x), _fmt(y), _fmt(geo.width), _fmt(geo.height), radius,
+                        html.escape(fill), html.escape(stroke)))
+            lines = _text_lines(cell.label, is_html)
+            if lines:
+                size = float(style.get("fontSize") or 12)
+                top = y + geo.height / 2 - (len(lines) - 1) * size * 0.6
+                shapes.append('<text x="%s" y="%s" font-size="%s" text-anchor="middle" dominant-baseline="middle">%s</text>' % (
+                    _fmt(x + geo.width / 2), _fmt(top), _fmt(size),
+                    "".join('<tspan x="%s" dy="%s">%s</tspan>' % (
+                        _fmt(x + geo.width / 2), "0" if i == 0 else _fmt(size * 1.2), html.escape(line))
+                        for i, line in enumerate(lines))))
+        elif cell.edge and geo is not None:
+            source = diagram.cells.get(cell.source) if cell.source else None
+            target = diagram.cells.get(cell.target) if cell.target else None
+            start = _terminal(source, origins, style, "exit", geo.source_point)
+            end = _terminal(target, origins, style, "entry", geo.target_point)
+            if start is None or end is None:
+                continue
+            points = [start] + [(p.x, p.y) for p in geo.points or ()] + [end]
+            if style.get("edgeStyle") in ("orthogonalEdgeStyle", "elbowEdgeStyle"):
+                points = _orthogonal(points)
+            xs += [p[0] for p in points]
+            ys += [p[1] for p in points]
+            edges.append('<polyline points="%s" fill="none" stroke="%s" marker-end="url(#arrow)" />' % (
+                " ".join("%s,%s" % (_fmt(px), _fmt(py)) for px, py in points),
+                html.escape(style.get("strokeColor") or "#000000")))
+            lines = _text_lines(cell.value, is_html)
+            if lines:
+                mid = len(points) // 2
+                (ax, ay), (bx, by) = points[mid - 1], points[mid]
+                edges.append('<text x="%s" y="%s" font-size="11" text-anchor="middle">%s</text>' % (
+                    _fmt((ax + bx) / 2), _fmt((ay + by) / 2 - 4), html.escape(" ".join(lines))))
+
+    left, top = min(xs) - 10, min(ys) - 10
+    width, height = max(xs) - left + 10, max(ys) - top + 10
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="%s %s %s %s" width="%s" height="%s" '
+        'font-family="Helvetica, Arial, sans-serif">'
+        '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="8" markerHeight="8" '
+        'orient="auto-start-reverse"><path d="M0,0 L10,5 L0,10 z" /></marker></defs>'
+        '<rect x="%s" y="%s" width="%s" height="%s" fill="#ffffff" />%s%s</svg>\n'
+    ) % (_fmt(left), _fmt(top), _fmt(width), _fmt(height), _fmt(width), _fmt(height),
+         _fmt(left), _fmt(top), _fmt(width), _fmt(height), "".join(edges), "".join(shapes))
+
+
+def cell_records(document: mxgraph.MxFile) -> list[dict]:
+    """
+    Flat list of all cells of all pages.
+    """
+    records = []
+    for page, diagram in enumerate(document.diagrams):
+        for cell in diagram.cells.values():
+            geo = cell.geometry
+            records.append({
+                "page": diagram.id if diagram.id is not None else page,
+                "id": cell.id,
+                "parent": cell.parent,
+                "kind": "vertex" if cell.vertex else "edge" if cell.edge else "cell",
+                "value": cell.label,
+                "style": cell.style,
+                "source": cell.source,
+                "target": cell.target,
+                "geometry": None if geo is None else {
+                    "x": geo.x, "y": geo.y, "width": geo.width, "height": geo.height,
+                    "relative": geo.relative,
+                    "points": None if geo.points is None else [[p.x, p.y] for p in geo.points],
+                },
+            })
+    return records
+
+
+def _convert_files(name: str, data: bytes, fmt: str) -> list[tuple[str, bytes]]:
+    if fmt == ExportFormatEnum.xml.value:
+        return [(name + ".xml", data)]
+    document = mxgraph.parse(data)
+    if fmt == ExportFormatEnum.json.value:
+        body = json.dumps({"name": name, "cells": cell_records(document)}, ensure_ascii=False)
+        return [(name + ".json", body.encode("utf-8"))]
+    pages = document.diagrams
+    files = []
+    for index, diagram in enumerate(pages):
+        filename = "%s.svg" % name if len(pages) == 1 else "%s-%d.svg" % (name, index + 1)
+        files.append((filename, render_svg(diagram).encode("utf-8")))
+    return files
+
+
+def _file_record(filename: str, data: bytes) -> dict:
+    try:
+        return {"filename": filename, "data": data.decode("utf-8")}
+    except UnicodeDecodeError:
+        # Stored XML in another encoding goes out byte for byte
+        return {"filename": filename, "data": base64.b64encode(data).decode("ascii"), "encoding": "base64"}
+
+
+def convert(name: str, data: bytes, fmt: str, container: str) -> dict:
+    """
+    Worker entry point. Returns ``{"name", "files": [(filename, bytes)]}`` for
+    zip, ``{"name", "line": bytes}`` for NDJSON, or ``{"name", "error"}``.
+    """
+    try:
+        files = _convert_files(name, data, fmt)
+        if container == ExportContainerEnum.zip.value:
+            return {"name": name, "files": files}
+        if fmt == ExportFormatEnum.json.value:
+            return {"name": name, "line": files[0][1] + b"\n"}
+        line = {"name": name, "format": fmt, "files": [_file_record(f, d) for f, d in files]}
+        return {"name": name, "line": json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n"}
+    except Exception as e:
+        return {"name": name, "error": "%s: %s" % (type(e).__name__, e)}
+
+
+# Batch pipeline, runs in the server / CLI process
+
+class _ZipSink:
+    """
+    Unseekable file object for zipfile: collects the bytes written so they
+    can be handed out after every entry.
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _ndjson(result: dict) -> bytes:
+    if "error" in result:
+        return json.dumps({"name": result["name"], "error": result["error"]}, ensure_ascii=False).encode("utf-8") + b"\n"
+    return result["line"]
+
+
+def _write_entries(archive: zipfile.ZipFile, result: dict) -> None:
+    if "error" in result:
+        archive.writestr(result["name"] + ".error.txt", result["error"])
+    else:
+        for filename, data in result["files"]:
+            archive.writestr(filename, data)
+
+
+async def _conversions(names: Iterable[str], fmt: ExportFormatEnum, container: ExportContainerEnum,
+                       repository: DiagramRepository, pool: ProcessPoolExecutor,
+                       window: int) -> AsyncIterator[dict]:
+    """
+    Keeps at most ``window`` diagrams loaded or converting at once and yields
+    results in completion order.
+    """
+    loop = asyncio.get_running_loop()
+    pending: set[asyncio.Future] = set()
+    names = iter(names)
+
+    async def submit(name: str) -> dict:
+        # A bad name, an unreadable file or a dead worker fails this item only
+        try:
+            stored = await repository.get(name)
+            if stored is None:
+                return {"name": name, "error": "not found"}
+            return await loop.run_in_executor(pool, convert, name, stored.data, fmt.value, container.value)
+        except (ValueError, OSError, zlib.error, BrokenExecutor) as e:
+            return {"name": name, "error": "%s: %s" % (type(e).__name__, e)}
+
+    exhausted = False
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < window:
+                name = next(names, None)
+                if name is None:
+                    exhausted = True
+                else:
+                    pending.add(asyncio.ensure_future(submit(name)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # Closed early (client went away): drop queued conversions
+        for future in pending:
+            future.cancel()
+
+
+async def export_batch(names: Iterable[str], fmt: ExportFormatEnum, container: ExportContainerEnum,
+                       repository: DiagramRepository, pool: ProcessPoolExecutor,
+                       window: int) -> AsyncIterator[bytes]:
+    async with aclosing(_conversions(names, fmt, container, repository, pool, window)) as results:
+        if container == ExportContainerEnum.ndjson:
+            async for result in results:
+                yield _ndjson(result)
+            return
+
+        sink = _ZipSink()
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            async for result in results:
+                # Deflating multi-MB entries would hold up the event loop; one entry is written at a time
+                await asyncio.to_thread(_write_entries, archive, result)
+                yield sink.drain()
+        yield sink.drain()
+
+
+def pool_size() -> int:
+    return get_settings().EXPORT_WORKERS or os.cpu_count() or 1
+
+
+def create_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Workers never fork the server process, which already runs the logging
+    listener and threadpool threads; forkserver where available, else spawn.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def get_export_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = create_pool(pool_size())
+    return _pool
+
+
+def shutdown_export_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export stored diagrams in bulk.")
+    parser.add_argument("names", nargs="*", help="diagram names (see GET /api/v1/diagrams)")
+    parser.add_argument("--all", action="store_true", help="export every stored diagram")
+    parser.add_argument("--format", choices=[f.value for f in ExportFormatEnum], default="svg")
+    parser.add_argument("--ndjson", action="store_true", help="write NDJSON instead of a zip archive")
+    parser.add_argument("--output", "-o", help="output file (default: stdout)")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (default: EXPORT_WORKERS / CPU count)")
+    args = parser.parse_args(argv)
+
+    if not args.names and not args.all:
+        parser.error("give diagram names or --all")
+
+    async def run() -> None:
+        repository = get_repository()
+        names = list(args.names)
+        if args.all:
+            names += [info.name for info in await repository.list()]
+        container = ExportContainerEnum.ndjson if args.ndjson else ExportContainerEnum.zip
+        workers = args.workers or pool_size()
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            with create_pool(workers) as pool:
+                async for chunk in export_batch(names, ExportFormatEnum(args.format), container,
+                                                repository, pool, window=workers * 2):
+                    out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
+            await repository.close()
+
+    asyncio.run(run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
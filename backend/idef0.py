@@ -0,0 +1,278 @@
+"""
+IDEF0 diagram generation: box placement, ICOM port assignment and
+orthogonal arrow routing, rendered to mxGraph XML.
+
+Every decomposition level is laid out independently and memoized by a hash
+of its content, so a request that edits one level only re-lays that level.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import mxgraph
+from config import get_settings
+from schemas import ArrowKindEnum, SArrow, SDecompositionLevel, SIDEF0Model
+
+
+BOX_WIDTH = 180
+BOX_HEIGHT = 90
+GAP_X = 120  # room for the vertical arrow channels between columns
+GAP_Y = 70
+MARGIN = 140  # room for boundary arrows and their labels
+BOUNDARY = 20
+STAIR = 6  # boxes per diagonal staircase before wrapping to a new band
+LANE_STEP = 12  # spacing between parallel arrows sharing a channel
+
+BOX_STYLE = {"rounded": "0", "whiteSpace": "wrap", "html": "1", "fillColor": "#ffffff"}
+NUMBER_STYLE = {"text": None, "html": "1", "align": "right", "verticalAlign": "bottom",
+                "strokeColor": "none", "fillColor": "none", "fontSize": "10"}
+ARROW_STYLE = {"edgeStyle": "orthogonalEdgeStyle", "rounded": "0", "orthogonalLoop": "1",
+               "html": "1", "endArrow": "classic"}
+
+_SIDES = {
+    ArrowKindEnum.input: "left",
+    ArrowKindEnum.control: "top",
+    ArrowKindEnum.mechanism: "bottom",
+}
+
+
+class _Box:
+    __slots__ = ("cell_id", "x", "y", "ports", "used")
+
+    def __init__(self, cell_id: str, x: float, y: float):
+        self.cell_id = cell_id
+        self.x = x
+        self.y = y
+        self.ports = {"left": 0, "top": 0, "bottom": 0, "right": 0}
+        self.used = {"left": 0, "top": 0, "bottom": 0, "right": 0}
+
+    @property
+    def right(self) -> float:
+        return self.x + BOX_WIDTH
+
+    @property
+    def bottom(self) -> float:
+        return self.y + BOX_HEIGHT
+
+    def take_port(self, side: str) -> tuple[float, float, int]:
+        """
+        Returns the next free port on ``side`` as (relative x, relative y, slot index).
+        """
+        slot = self.used[side]
+        self.used[side] += 1
+        fraction = (slot + 1) / (self.ports[side] + 1)
+        if side == "left":
+            return 0.0, fraction, slot
+        if side == "right":
+            return 1.0, fraction, slot
+        if side == "top":
+            return fraction, 0.0, slot
+        return fraction, 1.0, slot
+
+    def absolute(self, rx: float, ry: float) -> tuple[float, float]:
+        return self.x + rx * BOX_WIDTH, self.y + ry * BOX_HEIGHT
+
+
+def _place(index: int) -> tuple[float, float]:
+    band, step = divmod(index, STAIR)
+    x = MARGIN + step * (BOX_WIDTH + GAP_X)
+    y = MARGIN + band * STAIR * (BOX_HEIGHT + GAP_Y) + step * (BOX_HEIGHT + GAP_Y)
+    return x, y
+
+
+def _arrow_style(exit_: Optional[tuple[float, float]], entry: Optional[tuple[float, float]]) -> dict:
+    style = dict(ARROW_STYLE)
+    if exit_ is not None:
+        style.update(exitX=mxgraph.format_number(exit_[0]), exitY=mxgraph.format_number(exit_[1]), exitDx="0", exitDy="0")
+    if entry is not None:
+        style.update(entryX=mxgraph.format_number(entry[0]), entryY=mxgraph.format_number(entry[1]), entryDx="0", entryDy="0")
+    return style
+
+
+def _route(arrow: SArrow, source: Optional[_Box], target: Optional[_Box],
+           frame: tuple[float, float, float, float]) -> tuple[mxgraph.MxGeometry, dict]:
+    """
+    Computes the waypoints of one arrow. Arrows leave sources on the right
+    and enter targets on the side given by their ICOM kind.
+    """
+    left, top, right, bottom = frame
+    geo = mxgraph.MxGeometry(relative=True)
+    points = []
+
+    exit_ = entry = None
+    if source is not None:
+        rx, ry, out_slot = source.take_port("right")
+        exit_ = (rx, ry)
+        sx, sy = source.absolute(rx, ry)
+        channel = source.right + 20 + out_slot * LANE_STEP
+    if target is not None:
+        side = _SIDES[arrow.kind]
+        ex, ey, in_slot = target.take_port(side)
+        entry = (ex, ey)
+        tx, ty = target.absolute(ex, ey)
+
+    if source is None:
+        # Boundary arrow entering the target. Controls and mechanisms run along the
+        # column gap left of the target, clear of the boxes of other bands
+        if arrow.kind == ArrowKindEnum.input:
+            geo.source_point = mxgraph.MxPoint(left, ty)
+        else:
+            gap = target.x - GAP_X / 2 - in_slot * LANE_STEP
+            if arrow.kind == ArrowKindEnum.control:
+                lane = target.y - 20 - in_slot * LANE_STEP
+                geo.source_point = mxgraph.MxPoint(gap, top)
+            else:
+                lane = target.bottom + 20 + in_slot * LANE_STEP
+                geo.source_point = mxgraph.MxPoint(gap, bottom)
+            points = [(gap, lane), (tx, lane)]
+    elif target is None:
+        geo.target_point = mxgraph.MxPoint(right, sy)
+    elif arrow.kind == ArrowKindEnum.input:
+        if target.x - 20 > channel:
+            points = [(channel, sy), (channel, ty)]
+        else:
+            # Feedback: go around underneath both boxes
+            lane = max(source.bottom, target.bottom) + 30 + in_slot * LANE_STEP
+            back = target.x - 20 - in_slot * LANE_STEP
+            points = [(channel, sy), (channel, lane), (back, lane), (back, ty)]
+    elif arrow.kind == ArrowKindEnum.control:
+        lane = target.y - 20 - in_slot * LANE_STEP
+        points = [(channel, sy), (channel, lane), (tx, lane)]
+    else:
+        lane = target.bottom + 20 + in_slot * LANE_STEP
+        points = [(channel, sy), (channel, lane), (tx, lane)]
+
+    if points:
+        geo.points = [mxgraph.MxPoint(x, y) for x, y in points]
+    return geo, _arrow_style(exit_, entry)
+
+
+def layout_level(level: SDecompositionLevel) -> mxgraph.MxDiagram:
+    """
+    Lays out one decomposition level as a drawio page. Linear in the number
+    of activities and arrows. Cell ids are derived from the level alone, with
+    boxes, number labels and arrows in separate namespaces; the page id is
+    left for the caller to assign.
+    """
+    boxes: dict[str, _Box] = {}
+    for index, activity in enumerate(level.activities):
+        x, y = _place(index)
+        boxes[activity.id] = _Box("%s-box-%s" % (level.node, activity.id), x, y)
+
+    for arrow in level.arrows:
+        if arrow.source is not None:
+            boxes[arrow.source].ports["right"] += 1
+        if arrow.target is not None:
+            boxes[arrow.target].ports[_SIDES[arrow.kind]] += 1
+
+    frame = (
+        BOUNDARY,
+        BOUNDARY,
+        max(box.right for box in boxes.values()) + MARGIN - BOUNDARY,
+        max(box.bottom for box in boxes.values()) + MARGIN - BOUNDARY,
+    )
+
+    diagram = mxgraph.MxDiagram(None, ("%s %s" % (level.node, level.title)).strip(), {
+        "grid": "1", "gridSize": "10", "guides": "1", "tooltips": "1", "connect": "1", "arrows": "1",
+        "fold": "1", "page": "1", "pageScale": "1",
+        "pageWidth": mxgraph.format_number(frame[2] + BOUNDARY), "pageHeight": mxgraph.format_number(frame[3] + BOUNDARY),
+        "math": "0", "shadow": "0",
+    })
+    diagram.add(mxgraph.MxCell("0"))
+    diagram.add(mxgraph.MxCell("1", parent="0"))
+
+    for index, activity in enumerate(level.activities, start=1):
+        box = boxes[activity.id]
+        diagram.add(mxgraph.MxCell(
+            box.cell_id, parent="1", value=activity.name, style=dict(BOX_STYLE), vertex=True,
+            geometry=mxgraph.MxGeometry(box.x, box.y, BOX_WIDTH, BOX_HEIGHT),
+        ))
+        number = level.child_number(index)
+        diagram.add(mxgraph.MxCell(
+            "%s-number-%s" % (level.node, activity.id), parent=box.cell_id, value=number, style=dict(NUMBER_STYLE), vertex=True,
+            geometry=mxgraph.MxGeometry(BOX_WIDTH - 50, BOX_HEIGHT - 20, 45, 18),
+        ))
+
+    for index, arrow in enumerate(level.arrows):
+        source = boxes[arrow.source] if arrow.source is not None else None
+        target = boxes[arrow.target] if arrow.target is not None else None
+        geometry, style = _route(arrow, source, target, frame)
+        # Unnamed arrows are numbered apart from named ones, so "1" and the second unnamed arrow differ
+        arrow_id = "%s-arrow-%s" % (level.node, arrow.id) if arrow.id is not None else "%s-arrow#%d" % (level.node, index)
+        diagram.add(mxgraph.MxCell(
+            arrow_id, parent="1", value=arrow.label, style=style,
+            edge=True, source=source.cell_id if source else None, target=target.cell_id if target else None,
+            geometry=geometry,
+        ))
+    return diagram
+
+
+def _digest(data: str) -> str:
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+class LayoutCache:
+    """
+    Bounded LRU of rendered pages keyed by the content hash of their level,
+    so identical levels share an entry wherever they appear in a model.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._pages: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(self, level: SDecompositionLevel) -> tuple[str, str]:
+        """
+        Returns (content hash, serialized <mxGraphModel> element) for a level.
+        """
+        key = _digest(level.model_dump_json())
+        with self._lock:
+            xml = self._pages.get(key)
+            if xml is not None:
+                self.hits += 1
+                self._pages.move_to_end(key)
+                return key, xml
+            self.misses += 1
+
+        xml = "".join(mxgraph.iter_diagram_xml(layout_level(level), wrapped=False))
+        with self._lock:
+            self._pages[key] = xml
+            if len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+        return key, xml
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pages.clear()
+
+
+def generate(model: SIDEF0Model, cache: "LayoutCache") -> tuple[str, str]:
+    """
+    Renders a whole model, one drawio page per decomposition level.
+    Returns (content hash of the document, mxfile XML).
+    """
+    keys = []
+    pages = []
+    for index, level in enumerate(model.levels):
+        key, xml = cache.page(level)
+        page_id = "%s-%d" % (level.node, index)
+        keys.append(page_id + "\0" + key)
+        pages.append(mxgraph.diagram_header(page_id, ("%s %s" % (level.node, level.title)).strip())
+                     + xml + mxgraph.DIAGRAM_FOOTER)
+
+    header = mxgraph.file_header({"host": "IDEF0 Generator", "title": model.title} if model.title
+                                 else {"host": "IDEF0 Generator"})
+    return _digest(header + "".join(keys)), header + "".join(pages) + mxgraph.FILE_FOOTER
+
+
+_layout_cache: Optional[LayoutCache] = None
+
+def get_layout_cache() -> LayoutCache:
+    global _layout_cache
+    if _layout_cache is None:
+        _layout_cache = LayoutCache(get_settings().LAYOUT_CACHE_SIZE)
+    return _layout_cache
@@ -0,0 +1,79 @@
+"""
+Logging setup: records are handed to a queue on the calling thread and
+formatted / written by a background listener, so log I/O stays off the
+request path.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+from typing import Optional
+
+# Skip the stack walk that fills in filename / lineno for every record
+logging._srcfile = None
+
+# LogRecord attributes that are not user supplied ``extra`` fields
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line; ``extra={...}`` fields are included as keys.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records as they are. The stock ``prepare`` formats the message
+    on the calling thread and drops ``exc_info``; here formatting, including
+    tracebacks, happens on the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Loggers that uvicorn configures with their own synchronous stream handlers
+_SERVER_LOGGERS = ("uvicorn", "uvicorn.access")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging(level: int | str = logging.INFO, fmt: str = "json") -> None:
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler()
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.setLevel(level)
+    for name in _SERVER_LOGGERS:
+        # Send uvicorn's error and per-request access logs through the queue too
+        server_logger = logging.getLogger(name)
+        server_logger.handlers.clear()
+        server_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
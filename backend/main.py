@@ -1,24 +1,83 @@
+import asyncio
+import heapq
 import logging
-from pathlib import Path
-from typing import Annotated
+import xml.etree.ElementTree as ET
+import zlib
+from contextlib import asynccontextmanager, suppress
+from email.utils import formatdate
+from typing import Annotated, Iterator, Optional
+from urllib.parse import quote
 
-from fastapi import FastAPI,HTTPException, APIRouter, Depends
+from fastapi import FastAPI,HTTPException, APIRouter, Depends, Path, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 
+import mxgraph
 from config import get_settings
-from schemas import SDiagramQueryParams
+from log_config import setup_logging
+from metrics import MetricsMiddleware, MetricsRegistry, get_metrics
+from profiler import SamplingProfiler, get_profiler
+from diagram_cache import CachedDiagram, DiagramCache, get_diagram_cache, not_modified_since, parse_accept_encoding
+from export import export_batch, get_export_pool, pool_size, shutdown_export_pool
+from diagram_versions import DiagramVersions, PatchError, VersionTooOld, get_diagram_versions
+from idef0 import LayoutCache, generate, get_layout_cache
+from schemas import DiagramVariantEnum, ExportContainerEnum, SDiagramDiff, SDiagramInfo, SDiagramPatch, SDiagramQueryParams, SExportRequest, SIDEF0Model
+from schemas import SSearchCell, SSearchConnection, SSearchHit, SSearchResult
+from search_index import SearchIndex, extract, get_search_index
+from storage import NAME_PATTERN, BytesReader, DiagramReader, DiagramRepository, StoredDiagram, get_repository
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
-)
+setup_logging(get_settings().LOG_LEVEL, get_settings().LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
+async def watch_storage(repository: DiagramRepository, interval: float, stopping: asyncio.Event) -> None:
+    """
+    Lists the repository once per interval and hands the listing to the
+    diagram cache, the search index and the edited documents. The first pass
+    builds the search index. Returns after the current step once ``stopping``
+    is set.
+    """
+    refreshes=(("Diagram cache", get_diagram_cache().refresh), ("Search index", get_search_index().refresh),
+               ("Diagram versions", get_diagram_versions().refresh))
+    while not stopping.is_set():
+        try:
+            infos=await repository.list()
+        except Exception:
+            logger.exception("Listing diagrams failed")
+        else:
+            for what, refresh in refreshes:
+                if stopping.is_set():
+                    return
+                try:
+                    await refresh(infos)
+                except Exception:
+                    logger.exception("%s refresh failed", what)
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stopping.wait(), interval)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings=get_settings()
+    cache=get_diagram_cache()
+    await cache.warm([variant.value for variant in DiagramVariantEnum])
+
+    stopping=asyncio.Event()
+    watcher=asyncio.create_task(watch_storage(get_repository(), settings.CACHE_POLL_INTERVAL, stopping))
+    yield
+    # Stopped rather than cancelled: a cancelled task would leave its to_thread
+    # list() or get() running against the repository closed below
+    stopping.set()
+    await watcher
+    await get_diagram_versions().close()
+    get_profiler().stop()
+    shutdown_export_pool()
+    await get_repository().close()
+
 app=FastAPI(
     title="IDEF0 Generator",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -28,6 +87,29 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, registry=get_metrics(), profiler=get_profiler())
+
+def _cache_counters():
+    cache=get_diagram_cache()
+    layouts=get_layout_cache()
+    return [
+        ({"cache": "diagram", "result": "hit"}, cache.hits),
+        ({"cache": "diagram", "result": "miss"}, cache.misses),
+        ({"cache": "layout", "result": "hit"}, layouts.hits),
+        ({"cache": "layout", "result": "miss"}, layouts.misses),
+    ]
+
+get_metrics().register("cache_requests_total", "counter", "Cache lookups by cache and result.", _cache_counters)
+get_metrics().register("diagram_cache_bytes", "gauge", "Raw and precompressed bodies held by the diagram cache.",
+                       lambda: [({}, get_diagram_cache().bytes)])
+get_metrics().register("diagram_cache_evictions_total", "counter", "Diagrams evicted from the cache to stay within budget.",
+                       lambda: [({}, get_diagram_cache().evictions)])
+
+def _search_index_size():
+    index=get_search_index()
+    return [({"kind": "diagrams"}, len(index)), ({"kind": "terms"}, index.terms)]
+
+get_metrics().register("search_index_entries", "gauge", "Diagrams and distinct terms in the search index.", _search_index_size)
 
 
 router_v1 = APIRouter(prefix="/api/v1", tags=["Diagrams"])
@@ -36,28 +118,428 @@ router_v1 = APIRouter(prefix="/api/v1", tags=["Diagrams"])
 def health_check():
     return {"status":"ok", "service":"IDEF0 Generator Backend"}
 
+DiagramName = Annotated[str, Path(pattern=NAME_PATTERN.pattern)]
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def cached_response(request: Request, entry: CachedDiagram) -> Response:
+    """
+    Serves a cached diagram, honouring Accept-Encoding and conditional headers.
+    """
+    body, encoding = entry.select(request.headers.get("accept-encoding", ""))
+    headers = {
+        "ETag": entry.etag_for(encoding),
+        "Last-Modified": entry.last_modified,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if (if_none_match is not None and entry.matches(if_none_match)) or (
+        if_none_match is None and if_modified_since is not None
+        and entry.not_modified_since(if_modified_since)
+    ):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Disposition"] = content_disposition(entry.filename)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type='application/xml', headers=headers)
+
+def diagram_not_found(name: str) -> HTTPException:
+    error_msg = "Diagram %s not found" % name
+    logger.error(error_msg)
+    return HTTPException(status_code=404,detail=error_msg)
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Parses a single ``bytes=`` range into ``[start, end)``. None means the
+    whole body (malformed and multi-range headers are answered with 200).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise HTTPException(status_code=416,headers={"Content-Range": "bytes */%d" % size})
+            return max(size - suffix, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if last and end <= start:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416,headers={"Content-Range": "bytes */%d" % size})
+    return start, min(end, size)
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def ranged_response(request: Request, reader: DiagramReader, etag: str, last_modified: str,
+                    filename: str) -> Response:
+    """
+    Streams a diagram (or one byte range of it) from ``reader`` and closes
+    the reader once the body has been sent. Ranges always address the
+    uncompressed XML; full bodies are sent gzipped when the client accepts
+    it, straight from storage if the stored file already is gzip.
+    """
+    gzip_etag = '%s-gzip"' % etag[:-1]
+    span = None
+    unsatisfiable = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range in (etag, last_modified)):
+        try:
+            span = parse_range(range_header, reader.size)
+        except HTTPException as e:
+            unsatisfiable = e
+    gzipped = (span is None and unsatisfiable is None
+               and "gzip" in parse_accept_encoding(request.headers.get("accept-encoding", "")))
+
+    headers = {
+        "ETag": gzip_etag if gzipped else etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        not_modified = "*" in tags or etag in tags or gzip_etag in tags
+    else:
+        not_modified = if_modified_since is not None and not_modified_since(reader.modified_ns, if_modified_since)
+    if not_modified:
+        reader.close()
+        return Response(status_code=304, headers=headers)
+    if unsatisfiable is not None:
+        reader.close()
+        raise unsatisfiable
+
+    status = 200
+    start, end = 0, reader.size
+    headers["Content-Disposition"] = content_disposition(filename)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        if reader.encoding == "gzip":
+            headers["Content-Length"] = str(reader.stored_size)
+            chunks = reader.iter_stored()
+        else:
+            chunks = gzip_chunks(reader.iter_range(start, end))
+    else:
+        if span is not None:
+            start, end = span
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, reader.size)
+        headers["Content-Length"] = str(end - start)
+        chunks = reader.iter_range(start, end)
+
+    def body():
+        try:
+            yield from chunks
+        finally:
+            reader.close()
+
+    # Sync iterators are consumed in the threadpool, so inflating frames never blocks the loop
+    return StreamingResponse(body(), status_code=status, media_type='application/xml', headers=headers)
+
+async def serve_diagram(name: str, request: Request, cache: DiagramCache,
+                        repository: DiagramRepository) -> Response:
+    """
+    Small diagrams come from the in-memory cache; diagrams above
+    CACHE_MAX_BYTES and Range requests are streamed instead.
+    """
+    entry = cache.get(name)
+    if entry is None:
+        reader = await repository.open(name)
+        if reader is None:
+            raise diagram_not_found(name)
+        if reader.size > cache.max_bytes:
+            etag = '"%x-%x"' % (reader.modified_ns, reader.size)
+            last_modified = formatdate(reader.modified_ns / 1_000_000_000, usegmt=True)
+            return ranged_response(request, reader, etag, last_modified, f"{name}.xml")
+        reader.close()
+        entry = await cache.reload(name)
+        if entry is None:
+            raise diagram_not_found(name)
+
+    if "range" not in request.headers:
+        return cached_response(request, entry)
+    reader = BytesReader(StoredDiagram(name, entry.raw, entry.mtime_ns))
+    return ranged_response(request, reader, entry.etag, entry.last_modified, entry.filename)
+
+@app.get("/metrics",tags=["System"])
+async def metrics(registry: Annotated[MetricsRegistry, Depends(get_metrics)]):
+    # Rendered on the event loop, the only thread that writes the registry
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def require_profiler() -> SamplingProfiler:
+    if not get_settings().PROFILER_ALLOWED:
+        raise HTTPException(status_code=404,detail="Not Found")
+    return get_profiler()
+
+@app.post("/debug/profiler",tags=["System"])
+def toggle_profiler(
+    profiler: Annotated[SamplingProfiler, Depends(require_profiler)],
+    enabled: bool,
+    slow_ms: Annotated[Optional[float], Query(gt=0)] = None,
+):
+    """
+    Starts or stops stack sampling; ``slow_ms`` changes the slow-request threshold.
+    """
+    if slow_ms is not None:
+        profiler.slow_threshold = slow_ms / 1000
+    if enabled:
+        profiler.start()
+    else:
+        profiler.stop()
+    return {"running": profiler.running, "slow_ms": profiler.slow_threshold * 1000,
+            "slow_requests": profiler.slow_requests}
+
+@app.get("/debug/profile",tags=["System"])
+def get_profile(
+    profiler: Annotated[SamplingProfiler, Depends(require_profiler)],
+    reset: bool = False,
+):
+    """
+    Folded stacks of slow requests (flamegraph.pl / speedscope input).
+    """
+    folded = profiler.folded()
+    if reset:
+        profiler.reset()
+    return Response(content=folded, media_type="text/plain; charset=utf-8")
+
 @router_v1.get("/diagram")
-def get_diagram(params: Annotated[SDiagramQueryParams, Depends()]):
+async def get_diagram(
+    params: Annotated[SDiagramQueryParams, Depends()],
+    request: Request,
+    cache: Annotated[DiagramCache, Depends(get_diagram_cache)],
+    repository: Annotated[DiagramRepository, Depends(get_repository)],
+):
     """
     It returns an XML file.
     The frontend will call this endpoint and receive the file contents.
+    Bodies are served from memory (gzip/brotli when accepted) and
+    revalidated with ETag / Last-Modified; large diagrams are streamed
+    and support Range requests.
+    """
+    logger.info("Requested diagram", extra={"variant": params.variant.value})
+
+    return await serve_diagram(params.variant.value, request, cache, repository)
+
+@router_v1.get("/diagrams", response_model=list[SDiagramInfo])
+async def list_diagrams(repository: Annotated[DiagramRepository, Depends(get_repository)]):
+    return [SDiagramInfo.from_info(info) for info in await repository.list()]
+
+@router_v1.get("/diagrams/{name}")
+async def get_stored_diagram(
+    name: DiagramName,
+    request: Request,
+    cache: Annotated[DiagramCache, Depends(get_diagram_cache)],
+    repository: Annotated[DiagramRepository, Depends(get_repository)],
+):
+    return await serve_diagram(name, request, cache, repository)
+
+@router_v1.put("/diagrams/{name}", response_model=SDiagramInfo)
+async def save_diagram(
+    name: DiagramName,
+    request: Request,
+    repository: Annotated[DiagramRepository, Depends(get_repository)],
+    cache: Annotated[DiagramCache, Depends(get_diagram_cache)],
+    versions: Annotated[DiagramVersions, Depends(get_diagram_versions)],
+    search: Annotated[SearchIndex, Depends(get_search_index)],
+):
+    """
+    Stores the request body (mxGraph XML) under ``name``, replacing any previous version.
+    """
+    data = await request.body()
+    try:
+        parsed = await run_in_threadpool(mxgraph.parse, data)
+    except (ET.ParseError, ValueError) as e:
+        raise HTTPException(status_code=422,detail="Invalid diagram XML: %s" % e)
+
+    # Holding the write lock keeps a pending write-back of patches from overwriting this save
+    async with versions.writing(name):
+        info = await repository.put(name, data)
+        versions.discard(name)
+    cache.invalidate(name)
+    search.add(await run_in_threadpool(extract, info, parsed))
+    logger.info("Saved diagram %s (%d bytes)", name, info.size)
+    return SDiagramInfo.from_info(info)
+
+@router_v1.delete("/diagrams/{name}", status_code=204)
+async def delete_diagram(
+    name: DiagramName,
+    repository: Annotated[DiagramRepository, Depends(get_repository)],
+    cache: Annotated[DiagramCache, Depends(get_diagram_cache)],
+    versions: Annotated[DiagramVersions, Depends(get_diagram_versions)],
+    search: Annotated[SearchIndex, Depends(get_search_index)],
+):
+    async with versions.writing(name):
+        deleted = await repository.delete(name)
+        versions.discard(name)
+    if not deleted:
+        raise HTTPException(status_code=404,detail="Diagram %s not found" % name)
+    cache.invalidate(name)
+    search.remove(name)
+
+@router_v1.get("/search", response_model=SSearchResult)
+async def search_diagrams(
+    search: Annotated[SearchIndex, Depends(get_search_index)],
+    q: Annotated[Optional[str], Query(max_length=256)] = None,
+    feeds_from: Annotated[Optional[str], Query(max_length=256)] = None,
+    feeds_to: Annotated[Optional[str], Query(max_length=256)] = None,
+    prefix: bool = True,
+    limit: Annotated[int, Query(ge=1, le=500)] = 50,
+):
+    """
+    Finds stored diagrams by label text (``q``, every word must occur; the
+    last one also matches as a prefix) and/or by an arrow from the box
+    labelled ``feeds_from`` to the box labelled ``feeds_to``. Runs on the
+    event loop, which is the only place the index is modified.
+    """
+    if not (q or feeds_from or feeds_to):
+        raise HTTPException(status_code=422,detail="Pass q, feeds_from or feeds_to")
+
+    scores = search.match_text(q, prefix) if q else None
+    if feeds_from or feeds_to:
+        linked = search.match_edges(feeds_from, feeds_to)
+        if scores is None:
+            scores = linked
+        else:
+            scores = {name: score + linked[name] for name, score in scores.items() if name in linked}
+
+    top = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+    hits = []
+    for name, score in top:
+        cells = search.matching_cells(name, q, prefix) if q else []
+        connections = search.matching_connections(name, feeds_from, feeds_to) if feeds_from or feeds_to else []
+        hits.append(SSearchHit(
+            name=name,
+            score=score,
+            cells=[SSearchCell(page=c.page, id=c.cell, label=c.label, kind=c.kind) for c in cells],
+            connections=[SSearchConnection(page=c.page, edge=c.edge, source=c.source, target=c.target,
+                                           label=c.label) for c in connections],
+        ))
+    return SSearchResult(total=len(scores), indexed=len(search), hits=hits)
+
+async def get_versioned(name: str, versions: DiagramVersions):
+    try:
+        document = await versions.get(name)
+    except (ET.ParseError, ValueError) as e:
+        # Stored, but not something patches can apply to (no pages, unparseable)
+        raise HTTPException(status_code=409,detail="Diagram %s cannot be edited: %s" % (name, e))
+    if document is None:
+        raise diagram_not_found(name)
+    return document
+
+@router_v1.get("/diagram/{name}/versioned")
+async def get_versioned_diagram(
+    name: DiagramName,
+    versions: Annotated[DiagramVersions, Depends(get_diagram_versions)],
+):
+    """
+    Current state of the edited diagram; X-Diagram-Epoch and X-Diagram-Version
+    are the base for patches.
+    """
+    document = await get_versioned(name, versions)
+    return Response(content=document.to_xml(), media_type='application/xml',
+                    headers={"X-Diagram-Epoch": document.epoch, "X-Diagram-Version": str(document.version)})
+
+@router_v1.get("/diagram/{name}/patch", response_model=SDiagramDiff)
+async def get_diagram_diff(
+    name: DiagramName,
+    versions: Annotated[DiagramVersions, Depends(get_diagram_versions)],
+    epoch: str,
+    since: Annotated[int, Query(ge=0)],
+):
+    """
+    Cell-level changes made after version ``since`` of epoch ``epoch``.
+    """
+    document = await get_versioned(name, versions)
+    try:
+        document.check_base(epoch, since)
+        return document.diff(since)
+    except VersionTooOld as e:
+        raise HTTPException(status_code=409,detail=str(e))
+
+@router_v1.post("/diagram/{name}/patch", response_model=SDiagramDiff)
+async def patch_diagram(
+    name: DiagramName,
+    patch: SDiagramPatch,
+    versions: Annotated[DiagramVersions, Depends(get_diagram_versions)],
+):
+    """
+    Applies add / update / remove cell changes and returns everything that
+    changed since ``base_version``, including changes from other clients.
+    The document is written back to storage shortly afterwards.
+    """
+    document = await get_versioned(name, versions)
+    try:
+        # A stale base is refused before anything is applied
+        document.check_base(patch.epoch, patch.base_version)
+        if patch.changes:
+            document.apply(patch.changes, keep=patch.base_version)
+            versions.changed(name)
+        return document.diff(patch.base_version)
+    except PatchError as e:
+        raise HTTPException(status_code=422,detail=str(e))
+    except VersionTooOld as e:
+        raise HTTPException(status_code=409,detail=str(e))
+
+@router_v1.post("/export")
+async def export_diagrams(
+    request: SExportRequest,
+    repository: Annotated[DiagramRepository, Depends(get_repository)],
+):
+    """
+    Converts many stored diagrams at once (SVG pages, flat JSON cell lists
+    or raw XML). Conversions run in a process pool and the zip / NDJSON
+    response is streamed as they finish, so memory stays flat.
     """
-    logger.info("Requested diagram type: %s", params.variant.value)
-    
-    filename=f"{params.variant.value}.xml"
     settings=get_settings()
+    if len(request.names) > settings.EXPORT_MAX_BATCH:
+        raise HTTPException(status_code=422,detail="At most %d diagrams per export" % settings.EXPORT_MAX_BATCH)
+    for name in request.names:
+        if not NAME_PATTERN.match(name):
+            raise HTTPException(status_code=422,detail="Invalid diagram name %r" % name)
 
-    base_path = Path(settings.DATA_DIR)
-    file_path = base_path / filename
+    chunks = export_batch(request.names, request.format, request.container, repository,
+                          get_export_pool(), window=2 * pool_size())
+    if request.container == ExportContainerEnum.ndjson:
+        return StreamingResponse(chunks, media_type="application/x-ndjson")
+    return StreamingResponse(chunks, media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="diagrams-%s.zip"' % request.format.value})
 
+@router_v1.post("/diagram/generate")
+def generate_diagram(
+    model: SIDEF0Model,
+    cache: Annotated[LayoutCache, Depends(get_layout_cache)],
+):
+    """
+    Builds an IDEF0 diagram (one page per decomposition level) from a
+    structured description and returns it as mxGraph XML.
+    """
+    logger.info("Generating IDEF0 diagram: %d level(s)", len(model.levels))
 
-    if file_path.exists():
-        return FileResponse(file_path,media_type='application/xml',filename=filename)
-    else:
-        error_msg = "Diagram %s not found in %s" % (filename,base_path)
-        logger.error(error_msg)
-        raise HTTPException(status_code=404,detail=error_msg)
+    digest, xml = generate(model, cache)
+    return Response(content=xml, media_type='application/xml', headers={"ETag": '"%s"' % digest})
     
 app.include_router(router_v1)
-
-
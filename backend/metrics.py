@@ -0,0 +1,166 @@
+"""
+Request metrics in the Prometheus text exposition format.
+
+The middleware is plain ASGI (no per-request Request/Response objects) and
+labels requests by route template, so label cardinality stays bounded.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = tuple[tuple[str, str], ...]
+Collector = Callable[[], Iterable[tuple[dict[str, str], float]]]
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+
+
+def _value(value: float) -> str:
+    if isinstance(value, float):
+        return "+Inf" if value == float("inf") else repr(value)
+    return str(value)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+
+    def __init__(self, prefix: str = "idef0"):
+        self.prefix = prefix
+        self.in_flight = 0
+        self._requests: dict[Labels, int] = {}
+        self._latency: dict[Labels, _Histogram] = {}
+        self._bytes: dict[Labels, int] = {}
+        self._collectors: list[tuple[str, str, str, Collector]] = []
+
+    def observe(self, method: str, route: str, status: int, seconds: float, sent: int) -> None:
+        key = (("method", method), ("route", route))
+        status_key = key + (("status", str(status)),)
+        self._requests[status_key] = self._requests.get(status_key, 0) + 1
+        histogram = self._latency.get(key)
+        if histogram is None:
+            histogram = self._latency[key] = _Histogram()
+        histogram.observe(seconds)
+        self._bytes[key] = self._bytes.get(key, 0) + sent
+
+    def register(self, name: str, kind: str, help_text: str, collector: Collector) -> None:
+        """
+        Adds a metric whose samples are read from ``collector`` at scrape time.
+        """
+        self._collectors.append((name, kind, help_text, collector))
+
+    def render(self) -> str:
+        p = self.prefix
+        lines = [
+            "# HELP %s_http_requests_total HTTP requests by route and status." % p,
+            "# TYPE %s_http_requests_total counter" % p,
+        ]
+        lines += ["%s_http_requests_total%s %d" % (p, _labels(k), v) for k, v in self._requests.items()]
+
+        lines += [
+            "# HELP %s_http_request_duration_seconds Request latency by route." % p,
+            "# TYPE %s_http_request_duration_seconds histogram" % p,
+        ]
+        for key, histogram in self._latency.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append("%s_http_request_duration_seconds_bucket%s %d"
+                             % (p, _labels(key + (("le", _value(bound)),)), cumulative))
+            lines.append("%s_http_request_duration_seconds_bucket%s %d"
+                         % (p, _labels(key + (("le", "+Inf"),)), histogram.count))
+            lines.append("%s_http_request_duration_seconds_sum%s %r" % (p, _labels(key), histogram.sum))
+            lines.append("%s_http_request_duration_seconds_count%s %d" % (p, _labels(key), histogram.count))
+
+        lines += [
+            "# HELP %s_http_response_bytes_total Response body bytes sent by route." % p,
+            "# TYPE %s_http_response_bytes_total counter" % p,
+        ]
+        lines += ["%s_http_response_bytes_total%s %d" % (p, _labels(k), v) for k, v in self._bytes.items()]
+
+        lines += [
+            "# HELP %s_http_requests_in_flight Requests currently being served." % p,
+            "# TYPE %s_http_requests_in_flight gauge" % p,
+            "%s_http_requests_in_flight %d" % (p, self.in_flight),
+        ]
+
+        for name, kind, help_text, collector in self._collectors:
+            lines.append("# HELP %s_%s %s" % (p, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (p, name, kind))
+            for labels, value in collector():
+                lines.append("%s_%s%s %s" % (p, name, _labels(tuple(labels.items())), _value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def route_template(scope: dict) -> str:
+    route = scope.get("route")
+    return getattr(route, "path_format", None) or getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status and bytes sent for every HTTP request and
+    reports finished requests to the profiler, if one is attached.
+    """
+
+    def __init__(self, app, registry: MetricsRegistry, profiler=None):
+        self.app = app
+        self.registry = registry
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        registry = self.registry
+        status = 500
+        sent = 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        registry.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            end = time.perf_counter()
+            registry.in_flight -= 1
+            route = route_template(scope)
+            registry.observe(scope["method"], route, status, end - start, sent)
+            if self.profiler is not None:
+                self.profiler.request_finished(scope["method"], route, start, end)
+
+
+_registry: Optional[MetricsRegistry] = None
+
+def get_metrics() -> MetricsRegistry:
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry()
+    return _registry
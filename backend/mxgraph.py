@@ -0,0 +1,434 @@
+"""
+Streaming reader and writer for drawio / mxGraph XML documents.
+
+Documents are parsed with ``iterparse`` and every ``<mxCell>`` is released
+from the element tree as soon as it has been converted, so memory is bounded
+by the size of the typed model rather than by a full DOM.
+"""
+import base64
+import io
+import sys
+import zlib
+import xml.etree.ElementTree as ET
+from typing import IO, Iterator, Optional, Union
+from urllib.parse import unquote
+
+
+Source = Union[str, bytes, "IO[bytes]"]
+
+# Attributes that have a dedicated slot on MxCell, in drawio's write order
+_CELL_ATTRS = ("id", "value", "style", "parent", "vertex", "edge", "source", "target")
+_WRAPPER_TAGS = ("UserObject", "object")
+
+
+class MxPoint:
+    __slots__ = ("x", "y")
+
+    def __init__(self, x: float = 0.0, y: float = 0.0):
+        self.x = x
+        self.y = y
+
+    def __repr__(self) -> str:
+        return "MxPoint(%r, %r)" % (self.x, self.y)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MxPoint) and (self.x, self.y) == (other.x, other.y)
+
+
+class MxGeometry:
+    __slots__ = ("x", "y", "width", "height", "relative",
+                 "source_point", "target_point", "offset", "points", "attrs", "children")
+
+    def __init__(self, x: float = 0.0, y: float = 0.0, width: float = 0.0, height: float = 0.0,
+                 relative: bool = False):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.relative = relative
+        self.source_point: Optional[MxPoint] = None
+        self.target_point: Optional[MxPoint] = None
+        self.offset: Optional[MxPoint] = None
+        self.points: Optional[list[MxPoint]] = None
+        # Rarely used attributes / children kept verbatim for lossless round trips
+        self.attrs: Optional[dict[str, str]] = None
+        self.children: Optional[list[ET.Element]] = None
+
+    def __repr__(self) -> str:
+        return "MxGeometry(x=%r, y=%r, width=%r, height=%r)" % (self.x, self.y, self.width, self.height)
+
+
+class MxCell:
+    __slots__ = ("id", "value", "style", "parent", "vertex", "edge", "source", "target",
+                 "geometry", "attrs", "wrapper")
+
+    def __init__(self, id: str, parent: Optional[str] = None, value: Optional[str] = None,
+                 style: Optional[dict[str, Optional[str]]] = None, vertex: bool = False, edge: bool = False,
+                 source: Optional[str] = None, target: Optional[str] = None,
+                 geometry: Optional[MxGeometry] = None):
+        self.id = id
+        self.parent = parent
+        self.value = value
+        self.style = style
+        self.vertex = vertex
+        self.edge = edge
+        self.source = source
+        self.target = target
+        self.geometry = geometry
+        self.attrs: Optional[dict[str, str]] = None
+        # (tag, attributes) of an enclosing <UserObject>/<object>, if any
+        self.wrapper: Optional[tuple[str, dict[str, str]]] = None
+
+    @property
+    def label(self) -> Optional[str]:
+        if self.wrapper is not None:
+            return self.wrapper[1].get("label")
+        return self.value
+
+    def __repr__(self) -> str:
+        kind = "vertex" if self.vertex else "edge" if self.edge else "cell"
+        return "MxCell(%s %r)" % (kind, self.id)
+
+
+class MxDiagram:
+    __slots__ = ("id", "name", "model_attrs", "cells")
+
+    def __init__(self, id: Optional[str] = None, name: Optional[str] = None,
+                 model_attrs: Optional[dict[str, str]] = None):
+        self.id = id
+        self.name = name
+        self.model_attrs = model_attrs or {}
+        self.cells: dict[str, MxCell] = {}
+
+    @property
+    def vertices(self) -> Iterator[MxCell]:
+        return (cell for cell in self.cells.values() if cell.vertex)
+
+    @property
+    def edges(self) -> Iterator[MxCell]:
+        return (cell for cell in self.cells.values() if cell.edge)
+
+    def add(self, cell: MxCell) -> None:
+        self.cells[cell.id] = cell
+
+
+class MxFile:
+    """
+    A whole document. ``attrs`` is None for bare ``<mxGraphModel>`` documents.
+    """
+    __slots__ = ("attrs", "diagrams")
+
+    def __init__(self, attrs: Optional[dict[str, str]] = None):
+        self.attrs = attrs
+        self.diagrams: list[MxDiagram] = []
+
+
+def parse_style(style: Optional[str]) -> Optional[dict[str, Optional[str]]]:
+    """
+    ``"text;html=1;rounded=0;"`` -> ``{"text": None, "html": "1", "rounded": "0"}``
+    """
+    if style is None:
+        return None
+    result = {}
+    for item in style.split(";"):
+        if not item:
+            continue
+        key, sep, value = item.partition("=")
+        result[sys.intern(key)] = sys.intern(value) if sep else None
+    return result
+
+
+def format_style(style: Optional[dict[str, Optional[str]]]) -> Optional[str]:
+    if style is None:
+        return None
+    return "".join(key + ";" if value is None else "%s=%s;" % (key, value) for key, value in style.items())
+
+
+def _num(value: Optional[str]) -> float:
+    return float(value) if value else 0.0
+
+
+def format_number(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _point(elem: ET.Element) -> MxPoint:
+    return MxPoint(_num(elem.get("x")), _num(elem.get("y")))
+
+
+def _geometry(elem: ET.Element) -> MxGeometry:
+    attrs = dict(elem.attrib)
+    attrs.pop("as", None)
+    geo = MxGeometry(
+        _num(attrs.pop("x", None)), _num(attrs.pop("y", None)),
+        _num(attrs.pop("width", None)), _num(attrs.pop("height", None)),
+        attrs.pop("relative", None) == "1",
+    )
+    geo.attrs = attrs or None
+
+    for child in elem:
+        role = child.get("as")
+        if child.tag == "mxPoint" and role == "sourcePoint":
+            geo.source_point = _point(child)
+        elif child.tag == "mxPoint" and role == "targetPoint":
+            geo.target_point = _point(child)
+        elif child.tag == "mxPoint" and role == "offset":
+            geo.offset = _point(child)
+        elif child.tag == "Array" and role == "points":
+            geo.points = [_point(p) for p in child if p.tag == "mxPoint"]
+        else:
+            if geo.children is None:
+                geo.children = []
+            geo.children.append(child)
+    return geo
+
+
+def _cell(elem: ET.Element, wrapper: Optional[ET.Element]) -> MxCell:
+    attrs = dict(elem.attrib)
+    cell = MxCell(
+        id=attrs.pop("id", None) or (wrapper.get("id") if wrapper is not None else ""),
+        parent=attrs.pop("parent", None),
+        value=attrs.pop("value", None),
+        style=parse_style(attrs.pop("style", None)),
+        vertex=attrs.pop("vertex", None) == "1",
+        edge=attrs.pop("edge", None) == "1",
+        source=attrs.pop("source", None),
+        target=attrs.pop("target", None),
+    )
+    cell.attrs = attrs or None
+    for child in elem:
+        if child.tag == "mxGeometry":
+            cell.geometry = _geometry(child)
+            break
+    if wrapper is not None:
+        cell.wrapper = (wrapper.tag, dict(wrapper.attrib))
+    return cell
+
+
+def _decode_compressed(text: str) -> bytes:
+    """
+    drawio stores compressed pages as base64(raw deflate(urlencode(xml))).
+    """
+    try:
+        data = zlib.decompress(base64.b64decode(text), -15)
+    except zlib.error as e:
+        raise ValueError("Corrupt compressed diagram page: %s" % e) from e
+    return unquote(data.decode("utf-8")).encode("utf-8")
+
+
+def _events(source: Source) -> Iterator[tuple[str, ET.Element]]:
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return ET.iterparse(source, events=("start", "end"))
+
+
+def iterparse(source: Source) -> Iterator[tuple[str, Union[MxFile, MxDiagram, MxCell]]]:
+    """
+    Low level event stream: yields ``("file", MxFile)``, ``("diagram", MxDiagram)``
+    and ``("cell", MxCell)`` in document order. Cells are *not* attached to
+    their diagram here, callers decide what to retain.
+    """
+    stack: list[ET.Element] = []
+    root_elem: Optional[ET.Element] = None
+    diagram: Optional[MxDiagram] = None
+    in_file = False
+    in_model = False
+
+    for event, elem in _events(source):
+        tag = elem.tag
+        if event == "start":
+            stack.append(elem)
+            if tag == "mxfile":
+                in_file = True
+                yield "file", MxFile(dict(elem.attrib))
+            elif tag == "diagram":
+                diagram = MxDiagram(elem.get("id"), elem.get("name"))
+            elif tag == "mxGraphModel":
+                if diagram is None:
+                    if not in_file:
+                        # Bare <mxGraphModel> document without an <mxfile> envelope
+                        yield "file", MxFile(None)
+                    diagram = MxDiagram()
+                in_model = True
+                diagram.model_attrs = dict(elem.attrib)
+                yield "diagram", diagram
+            elif tag == "root":
+                root_elem = elem
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if tag == "mxCell" and parent is not None and parent.tag in ("root", *_WRAPPER_TAGS):
+            if not in_model:
+                raise ValueError("mxCell %r outside of an <mxGraphModel>" % elem.get("id"))
+            wrapper = parent if parent.tag in _WRAPPER_TAGS else None
+            yield "cell", _cell(elem, wrapper)
+            if wrapper is None and root_elem is not None:
+                root_elem.clear()
+        elif tag in _WRAPPER_TAGS and parent is root_elem and root_elem is not None:
+            root_elem.clear()
+        elif tag == "mxGraphModel":
+            in_model = False
+            if parent is None or parent.tag != "diagram":
+                diagram = None
+        elif tag == "diagram":
+            if diagram is not None and len(elem) == 0 and (elem.text or "").strip():
+                compressed = MxDiagram(diagram.id, diagram.name)
+                for kind, item in iterparse(_decode_compressed(elem.text.strip())):
+                    if kind == "diagram":
+                        compressed.model_attrs = item.model_attrs
+                        yield "diagram", compressed
+                    elif kind == "cell":
+                        yield kind, item
+            diagram = None
+            root_elem = None
+            elem.clear()
+
+
+def iter_cells(source: Source) -> Iterator[tuple[MxDiagram, MxCell]]:
+    """
+    Streams ``(diagram, cell)`` pairs without retaining any cell.
+    """
+    diagram = None
+    for kind, item in iterparse(source):
+        if kind == "diagram":
+            diagram = item
+        elif kind == "cell":
+            yield diagram, item
+
+
+def parse(source: Source) -> MxFile:
+    """
+    Parses a path, bytes or binary file object into an MxFile.
+    """
+    mxfile = None
+    diagram = None
+    for kind, item in iterparse(source):
+        if kind == "file":
+            mxfile = item
+        elif kind == "diagram":
+            diagram = item
+            mxfile.diagrams.append(diagram)
+        else:
+            diagram.add(item)
+    if mxfile is None:
+        raise ValueError("Not an mxGraph document")
+    return mxfile
+
+
+_ATTR_ESCAPES = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;",
+    "\n": "&#xa;", "\r": "&#xd;", "\t": "&#x9;",
+})
+
+
+def _attrs(pairs) -> str:
+    return "".join(' %s="%s"' % (key, value.translate(_ATTR_ESCAPES))
+                   for key, value in pairs if value is not None)
+
+
+def _point_xml(point: MxPoint, role: Optional[str]) -> str:
+    return "<mxPoint%s />" % _attrs((
+        ("x", format_number(point.x) if point.x else None),
+        ("y", format_number(point.y) if point.y else None),
+        ("as", role),
+    ))
+
+
+def _geometry_xml(geo: MxGeometry) -> str:
+    head = "<mxGeometry%s" % _attrs((
+        ("x", format_number(geo.x) if geo.x else None),
+        ("y", format_number(geo.y) if geo.y else None),
+        ("width", format_number(geo.width) if geo.width else None),
+        ("height", format_number(geo.height) if geo.height else None),
+        ("relative", "1" if geo.relative else None),
+        *(geo.attrs or {}).items(),
+        ("as", "geometry"),
+    ))
+    body = []
+    if geo.source_point is not None:
+        body.append(_point_xml(geo.source_point, "sourcePoint"))
+    if geo.target_point is not None:
+        body.append(_point_xml(geo.target_point, "targetPoint"))
+    if geo.points is not None:
+        body.append('<Array as="points">%s</Array>' % "".join(_point_xml(p, None) for p in geo.points))
+    if geo.offset is not None:
+        body.append(_point_xml(geo.offset, "offset"))
+    for child in geo.children or ():
+        body.append(ET.tostring(child, encoding="unicode").strip())
+    if not body:
+        return head + " />"
+    return head + ">" + "".join(body) + "</mxGeometry>"
+
+
+def cell_to_xml(cell: MxCell) -> str:
+    values = {
+        "id": cell.id if cell.wrapper is None else None,
+        "value": cell.value,
+        "style": format_style(cell.style),
+        "parent": cell.parent,
+        "vertex": "1" if cell.vertex else None,
+        "edge": "1" if cell.edge else None,
+        "source": cell.source,
+        "target": cell.target,
+    }
+    head = "<mxCell%s" % _attrs((*((key, values[key]) for key in _CELL_ATTRS), *(cell.attrs or {}).items()))
+    if cell.geometry is None:
+        xml = head + " />"
+    else:
+        xml = head + ">" + _geometry_xml(cell.geometry) + "</mxCell>"
+    if cell.wrapper is not None:
+        tag, attrs = cell.wrapper
+        xml = "<%s%s>%s</%s>" % (tag, _attrs(attrs.items()), xml, tag)
+    return xml
+
+
+def iter_diagram_xml(diagram: MxDiagram, wrapped: bool = True) -> Iterator[str]:
+    """
+    Serializes one page; ``wrapped`` adds the ``<diagram>`` element.
+    """
+    if wrapped:
+        yield diagram_header(diagram.id, diagram.name)
+    yield "    <mxGraphModel%s>\n      <root>\n" % _attrs(diagram.model_attrs.items())
+    for cell in diagram.cells.values():
+        yield "        " + cell_to_xml(cell) + "\n"
+    yield "      </root>\n    </mxGraphModel>\n"
+    if wrapped:
+        yield DIAGRAM_FOOTER
+
+
+def diagram_header(id: Optional[str], name: Optional[str]) -> str:
+    return "  <diagram%s>\n" % _attrs((("id", id), ("name", name)))
+
+
+DIAGRAM_FOOTER = "  </diagram>\n"
+
+
+def file_header(attrs: dict[str, str]) -> str:
+    return "<mxfile%s>\n" % _attrs(attrs.items())
+
+
+FILE_FOOTER = "</mxfile>\n"
+
+
+def iter_xml(mxfile: MxFile) -> Iterator[str]:
+    """
+    Serializes a document chunk by chunk, one cell per chunk.
+    """
+    wrapped = mxfile.attrs is not None
+    if wrapped:
+        yield file_header(mxfile.attrs)
+    for diagram in mxfile.diagrams:
+        yield from iter_diagram_xml(diagram, wrapped)
+    if wrapped:
+        yield FILE_FOOTER
+
+
+def dumps(mxfile: MxFile) -> str:
+    return "".join(iter_xml(mxfile))
+
+
+def dump(mxfile: MxFile, fp: IO[str]) -> None:
+    for chunk in iter_xml(mxfile):
+        fp.write(chunk)
@@ -0,0 +1,116 @@
+"""
+Opt-in sampling profiler for slow requests.
+
+While running, a daemon thread snapshots the stack of every Python thread at
+a fixed interval into a bounded ring buffer. When a request finishes slower
+than the threshold, the samples taken during it are folded into
+``route;frame;frame count`` lines, the input format of flamegraph.pl and
+speedscope. Threads parked in a wait (idle pool workers, the logging
+listener, the event loop blocked in ``select``) are not sampled, so the
+folded stacks show the code that was actually running.
+"""
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional
+
+from config import get_settings
+
+# (file, function) of the innermost frame of a thread that is waiting for work
+_IDLE_FRAMES = frozenset({
+    ("threading.py", "wait"),  # Condition.wait: queue.Queue.get, anyio / starlette workers
+    ("threading.py", "_wait_for_tstate_lock"),  # Thread.join
+    ("selectors.py", "select"),  # event loop with nothing to run
+    ("thread.py", "_worker"),  # concurrent.futures worker blocked in SimpleQueue.get
+    ("handlers.py", "dequeue"),  # logging QueueListener blocked in SimpleQueue.get
+})
+
+
+def _idle(frame) -> bool:
+    code = frame.f_code
+    return (code.co_filename.rsplit("/", 1)[-1], code.co_name) in _IDLE_FRAMES
+
+
+def _fold(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("%s (%s:%d)" % (code.co_name, code.co_filename.rsplit("/", 1)[-1], frame.f_lineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval: float, slow_threshold: float, max_samples: int = 20000):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.slow_requests = 0
+        self._samples: deque[tuple[float, str]] = deque(maxlen=max_samples)
+        self._stacks: Counter[str] = Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._samples.clear()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident != own and not _idle(frame):
+                    self._samples.append((now, _fold(frame)))
+
+    def request_finished(self, method: str, route: str, start: float, end: float) -> None:
+        if self._thread is None or end - start < self.slow_threshold:
+            return
+        root = "%s %s" % (method, route)
+        # Samples are appended in time order, so scan back from the newest
+        window = []
+        for taken, stack in reversed(list(self._samples)):
+            if taken < start:
+                break
+            if taken <= end:
+                window.append(stack)
+        with self._lock:
+            self.slow_requests += 1
+            for stack in window:
+                self._stacks[root + ";" + stack] += 1
+
+    def folded(self) -> str:
+        with self._lock:
+            return "".join("%s %d\n" % item for item in self._stacks.most_common())
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+            self.slow_requests = 0
+
+
+_profiler: Optional[SamplingProfiler] = None
+
+def get_profiler() -> SamplingProfiler:
+    global _profiler
+    if _profiler is None:
+        settings = get_settings()
+        _profiler = SamplingProfiler(settings.PROFILER_INTERVAL_MS / 1000, settings.PROFILER_SLOW_MS / 1000)
+    return _profiler
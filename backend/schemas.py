@@ -1,5 +1,8 @@
+from datetime import datetime, timezone
 from enum import Enum
-from pydantic import BaseModel
+from typing import Optional
+
+from pydantic import BaseModel, Field, model_validator
 
 
 class DiagramVariantEnum(Enum):
@@ -9,3 +12,197 @@ class DiagramVariantEnum(Enum):
 
 class SDiagramQueryParams(BaseModel):
     variant: DiagramVariantEnum
+
+
+class ArrowKindEnum(Enum):
+    input = "input"
+    control = "control"
+    output = "output"
+    mechanism = "mechanism"
+
+class SActivity(BaseModel):
+    id: str = Field(min_length=1)
+    name: str
+    number: Optional[str] = None  # defaults to the node number derived from the level
+
+class SArrow(BaseModel):
+    """
+    ICOM arrow. ``source`` is always attached to the output side of an activity,
+    ``kind`` says which side of ``target`` it enters. Omitted ends are the diagram boundary.
+    """
+    id: Optional[str] = None
+    label: str = ""
+    kind: ArrowKindEnum
+    source: Optional[str] = None
+    target: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_ends(self):
+        if self.source is None and self.target is None:
+            raise ValueError("arrow needs a source or a target activity")
+        if self.target is None and self.kind != ArrowKindEnum.output:
+            raise ValueError("arrows leaving the diagram boundary must be outputs")
+        if self.target is not None and self.kind == ArrowKindEnum.output:
+            raise ValueError("arrows entering an activity must be input, control or mechanism")
+        return self
+
+class SDecompositionLevel(BaseModel):
+    """
+    One IDEF0 page. ``parent_activity`` is the id of the activity of an upper
+    level this page decomposes; ``node`` then defaults to that activity's number.
+    """
+    node: str = "A0"
+    title: str = ""
+    parent_activity: Optional[str] = None
+    activities: list[SActivity] = Field(min_length=1)
+    arrows: list[SArrow] = []
+
+    @model_validator(mode="after")
+    def check_references(self):
+        ids = [activity.id for activity in self.activities]
+        if len(set(ids)) != len(ids):
+            raise ValueError("activity ids must be unique within a level")
+        arrow_ids = [arrow.id for arrow in self.arrows if arrow.id is not None]
+        if len(set(arrow_ids)) != len(arrow_ids):
+            raise ValueError("arrow ids must be unique within a level")
+        known = set(ids)
+        for arrow in self.arrows:
+            for end in (arrow.source, arrow.target):
+                if end is not None and end not in known:
+                    raise ValueError("arrow references unknown activity %r" % end)
+        return self
+
+    def child_number(self, index: int) -> str:
+        """
+        Node number of the ``index``-th activity (from 1) of this level.
+        """
+        number = self.activities[index - 1].number
+        if number:
+            return number
+        # The A-0 context box is A0, A0 decomposes into A1..An, A1 into A11..A1n
+        if self.node == "A-0":
+            return "A0"
+        return "A%d" % index if self.node == "A0" else "%s%d" % (self.node, index)
+
+class SIDEF0Model(BaseModel):
+    title: str = ""
+    levels: list[SDecompositionLevel] = Field(min_length=1)
+
+    @model_validator(mode="after")
+    def link_levels(self):
+        numbers: dict[str, set[str]] = {}  # activity id -> its numbers on the levels seen so far
+        for level in self.levels:
+            if level.parent_activity is not None:
+                candidates = numbers.get(level.parent_activity)
+                if not candidates:
+                    raise ValueError("parent_activity %r is not an activity of an upper level" % level.parent_activity)
+                if len(candidates) > 1:
+                    raise ValueError("parent_activity %r is ambiguous: %s"
+                                     % (level.parent_activity, ", ".join(sorted(candidates))))
+                [node] = candidates
+                if "node" in level.model_fields_set and level.node != node:
+                    raise ValueError("level %s decomposes activity %r, which is numbered %s"
+                                     % (level.node, level.parent_activity, node))
+                level.node = node
+            for index, activity in enumerate(level.activities, start=1):
+                numbers.setdefault(activity.id, set()).add(level.child_number(index))
+        return self
+
+
+class CellOpEnum(Enum):
+    add = "add"
+    update = "update"
+    remove = "remove"
+
+class SPoint(BaseModel):
+    x: float = 0.0
+    y: float = 0.0
+
+class SGeometry(BaseModel):
+    x: float = 0.0
+    y: float = 0.0
+    width: float = 0.0
+    height: float = 0.0
+    relative: bool = False
+    points: Optional[list[SPoint]] = None
+    source_point: Optional[SPoint] = None
+    target_point: Optional[SPoint] = None
+
+class SCellChange(BaseModel):
+    """
+    One cell-level delta keyed by mxCell id. For ``update`` only the fields
+    that are present are changed; ``style`` uses the drawio ``key=value;`` format.
+    """
+    op: CellOpEnum
+    id: str = Field(min_length=1)
+    page: Optional[str] = None  # <diagram> id, defaults to the first page
+    parent: Optional[str] = None
+    value: Optional[str] = None
+    style: Optional[str] = None
+    vertex: Optional[bool] = None
+    edge: Optional[bool] = None
+    source: Optional[str] = None
+    target: Optional[str] = None
+    geometry: Optional[SGeometry] = None
+
+class SDiagramPatch(BaseModel):
+    epoch: str  # X-Diagram-Epoch of the document base_version belongs to
+    base_version: int = Field(ge=0)
+    changes: list[SCellChange] = []
+
+class SDiagramDiff(BaseModel):
+    epoch: str
+    version: int
+    since: int
+    changes: list[SCellChange]
+
+
+class SDiagramInfo(BaseModel):
+    name: str
+    size: int
+    modified: datetime
+
+    @classmethod
+    def from_info(cls, info) -> "SDiagramInfo":
+        return cls(name=info.name, size=info.size,
+                   modified=datetime.fromtimestamp(info.modified_ns / 1_000_000_000, tz=timezone.utc))
+
+
+class ExportFormatEnum(Enum):
+    svg = "svg"
+    json = "json"
+    xml = "xml"
+
+class ExportContainerEnum(Enum):
+    zip = "zip"
+    ndjson = "ndjson"
+
+class SExportRequest(BaseModel):
+    names: list[str] = Field(min_length=1)
+    format: ExportFormatEnum = ExportFormatEnum.svg
+    container: ExportContainerEnum = ExportContainerEnum.zip
+
+
+class SSearchCell(BaseModel):
+    page: Optional[str] = None
+    id: str
+    label: str
+    kind: str  # vertex / edge / cell
+
+class SSearchConnection(BaseModel):
+    page: Optional[str] = None
+    edge: str
+    source: str
+    target: str
+    label: str = ""
+
+class SSearchHit(BaseModel):
+    name: str
+    score: int
+    cells: list[SSearchCell] = []
+    connections: list[SSearchConnection] = []
+
+class SSearchResult(BaseModel):
+    total: int
+    indexed: int
+    hits: list[SSearchHit]
@@ -0,0 +1,319 @@
+"""
+In-memory search over every stored diagram.
+
+Two indexes are kept per repository:
+
+* an inverted index from label tokens (casefolded, HTML stripped, any
+  script) to the diagrams containing them, with per-diagram term counts
+  for ranking;
+* an edge adjacency index from a box label to the labels of the boxes its
+  arrows feed, and the reverse.
+
+Diagrams are parsed in worker threads; the indexes themselves are only
+touched from the event loop, so they need no locking. ``refresh`` takes a
+repository listing and reindexes just the diagrams whose (mtime, size) changed.
+"""
+import asyncio
+import html
+import logging
+import re
+import xml.etree.ElementTree as ET
+import zlib
+from bisect import bisect_left, insort
+from collections import Counter
+from typing import Optional
+
+import mxgraph
+from storage import DiagramInfo, DiagramRepository, get_repository
+
+
+logger = logging.getLogger(__name__)
+
+_TAG = re.compile(r"<[^>]+>")
+_TOKEN = re.compile(r"\w+")
+MAX_PREFIX_TERMS = 200  # vocabulary terms a trailing prefix may expand to
+
+
+def label_text(value: Optional[str]) -> str:
+    """
+    Plain text of a label; drawio stores HTML labels with tags and entities.
+    """
+    if not value:
+        return ""
+    if "<" in value or "&" in value:
+        value = html.unescape(_TAG.sub(" ", value))
+    return " ".join(value.split())
+
+
+def tokenize(text: str) -> list[str]:
+    # "ё" and "е" are used interchangeably in Russian labels
+    return _TOKEN.findall(text.casefold().replace("ё", "е"))
+
+
+def label_key(text: str) -> str:
+    return " ".join(tokenize(text))
+
+
+class CellLabel:
+    __slots__ = ("page", "cell", "label", "kind", "terms")
+
+    def __init__(self, page: Optional[str], cell: str, label: str, kind: str, terms: frozenset[str]):
+        self.page = page
+        self.cell = cell
+        self.label = label
+        self.kind = kind
+        self.terms = terms
+
+
+class Connection:
+    """
+    One arrow between two labelled boxes.
+    """
+    __slots__ = ("page", "edge", "source", "target", "label")
+
+    def __init__(self, page: Optional[str], edge: str, source: str, target: str, label: str):
+        self.page = page
+        self.edge = edge
+        self.source = source
+        self.target = target
+        self.label = label
+
+
+class IndexedDiagram:
+    __slots__ = ("name", "modified_ns", "size", "labels", "connections", "terms")
+
+    def __init__(self, name: str, modified_ns: int, size: int):
+        self.name = name
+        self.modified_ns = modified_ns
+        self.size = size
+        self.labels: list[CellLabel] = []
+        self.connections: list[Connection] = []
+        self.terms: Counter[str] = Counter()
+
+
+def extract(info: DiagramInfo, mxfile: mxgraph.MxFile) -> IndexedDiagram:
+    """
+    Collects labels and box-to-box arrows of a parsed diagram. CPU bound.
+    """
+    document = IndexedDiagram(info.name, info.modified_ns, info.size)
+    for diagram in mxfile.diagrams:
+        texts = {cell_id: label_text(cell.label) for cell_id, cell in diagram.cells.items()}
+        # Text cells attached to an arrow (drawio edge labels) name that arrow
+        edge_labels: dict[str, list[str]] = {}
+        for cell in diagram.cells.values():
+            text = texts[cell.id]
+            if not text:
+                continue
+            parent = diagram.cells.get(cell.parent) if cell.parent is not None else None
+            if parent is not None and parent.edge:
+                edge_labels.setdefault(parent.id, []).append(text)
+            terms = tokenize(text)
+            if not terms:
+                continue
+            kind = "edge" if cell.edge else "vertex" if cell.vertex else "cell"
+            document.labels.append(CellLabel(diagram.id, cell.id, text, kind, frozenset(terms)))
+            document.terms.update(terms)
+
+        for edge in diagram.edges:
+            source, target = texts.get(edge.source or ""), texts.get(edge.target or "")
+            if source and target:
+                label = " ".join([texts[edge.id], *edge_labels.get(edge.id, ())]).strip()
+                document.connections.append(Connection(diagram.id, edge.id, source, target, label))
+    return document
+
+
+def _parse_stored(info: DiagramInfo, data: bytes) -> IndexedDiagram:
+    return extract(info, mxgraph.parse(data))
+
+
+class SearchIndex:
+
+    def __init__(self, repository: DiagramRepository):
+        self.repository = repository
+        self._documents: dict[str, IndexedDiagram] = {}
+        self._postings: dict[str, dict[str, int]] = {}  # term -> {diagram: occurrences}
+        self._vocabulary: list[str] = []  # sorted terms, for prefix lookups
+        self._feeds: dict[str, dict[str, dict[str, int]]] = {}  # source key -> target key -> {diagram: arrows}
+        self._fed_by: dict[str, dict[str, dict[str, int]]] = {}  # target key -> source key -> {diagram: arrows}
+        self._failed: dict[str, tuple[int, int]] = {}  # unparseable diagrams, not retried until changed
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    @property
+    def terms(self) -> int:
+        return len(self._vocabulary)
+
+    def add(self, document: IndexedDiagram) -> None:
+        self.remove(document.name)
+        self._documents[document.name] = document
+        for term, count in document.terms.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                insort(self._vocabulary, term)
+            postings[document.name] = count
+        for connection in document.connections:
+            source, target = label_key(connection.source), label_key(connection.target)
+            for adjacency, key, other in ((self._feeds, source, target), (self._fed_by, target, source)):
+                names = adjacency.setdefault(key, {}).setdefault(other, {})
+                names[document.name] = names.get(document.name, 0) + 1
+
+    def remove(self, name: str) -> None:
+        self._failed.pop(name, None)
+        document = self._documents.pop(name, None)
+        if document is None:
+            return
+        for term in document.terms:
+            postings = self._postings[term]
+            del postings[name]
+            if not postings:
+                del self._postings[term]
+                del self._vocabulary[bisect_left(self._vocabulary, term)]
+        for source, target in {(label_key(c.source), label_key(c.target)) for c in document.connections}:
+            _discard(self._feeds, source, target, name)
+            _discard(self._fed_by, target, source, name)
+
+    async def reindex(self, info: DiagramInfo) -> None:
+        try:
+            stored = await self.repository.get(info.name)
+            if stored is None:
+                self.remove(info.name)
+                return
+            document = await asyncio.to_thread(_parse_stored, info, stored.data)
+        except (ET.ParseError, ValueError, zlib.error) as e:
+            logger.warning("Cannot index diagram %s: %s", info.name, e)
+            self.remove(info.name)
+            self._failed[info.name] = (info.modified_ns, info.size)
+            return
+        self.add(document)
+
+    async def refresh(self, infos: Optional[list[DiagramInfo]] = None) -> list[str]:
+        """
+        Reindexes diagrams new, changed or removed according to ``infos``, a
+        listing of the repository (taken here when not given). Returns their
+        names.
+        """
+        if infos is None:
+            infos = await self.repository.list()
+        seen = {info.name: info for info in infos}
+
+        changed = [name for name in self._documents if name not in seen]
+        for name in changed:
+            self.remove(name)
+        for name in [name for name in self._failed if name not in seen]:
+            del self._failed[name]
+        for name, info in seen.items():
+            state = (info.modified_ns, info.size)
+            document = self._documents.get(name)
+            if document is not None and (document.modified_ns, document.size) == state:
+                continue
+            if self._failed.get(name) == state:
+                continue
+            changed.append(name)
+            try:
+                await self.reindex(info)
+            except Exception:
+                # One unreadable diagram must not keep the rest out of the index
+                logger.exception("Cannot index diagram %s", name)
+                self._failed[name] = state
+        if changed:
+            logger.info("Search index updated: %d diagram(s) changed, %d indexed", len(changed), len(self))
+        return changed
+
+    def _expand(self, term: str) -> list[str]:
+        start = bisect_left(self._vocabulary, term)
+        result = []
+        for candidate in self._vocabulary[start:start + MAX_PREFIX_TERMS]:
+            if not candidate.startswith(term):
+                break
+            result.append(candidate)
+        return result
+
+    def match_text(self, query: str, prefix: bool = True) -> dict[str, int]:
+        """
+        Diagrams containing every query token, scored by token occurrences.
+        With ``prefix`` the last token also matches longer terms, so results
+        follow the user while typing.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return {}
+        groups = [[token] for token in tokens]
+        if prefix:
+            groups[-1] = self._expand(tokens[-1])
+
+        scores: Optional[dict[str, int]] = None
+        # Intersect starting from the rarest group to keep the working set small
+        for group in sorted(groups, key=lambda g: sum(len(self._postings.get(t, ())) for t in g)):
+            merged: dict[str, int] = {}
+            for term in group:
+                for name, count in self._postings.get(term, {}).items():
+                    merged[name] = merged.get(name, 0) + count
+            if scores is None:
+                scores = merged
+            else:
+                scores = {name: score + merged[name] for name, score in scores.items() if name in merged}
+            if not scores:
+                return {}
+        return scores or {}
+
+    def match_edges(self, feeds_from: Optional[str], feeds_to: Optional[str]) -> dict[str, int]:
+        """
+        Diagrams with an arrow from a box labelled ``feeds_from`` to a box
+        labelled ``feeds_to`` (either side may be omitted), scored by the
+        number of such arrows.
+        """
+        source = label_key(feeds_from) if feeds_from else None
+        target = label_key(feeds_to) if feeds_to else None
+        if source is not None and target is not None:
+            return dict(self._feeds.get(source, {}).get(target, {}))
+        adjacency = self._feeds.get(source, {}) if source is not None else self._fed_by.get(target or "", {})
+        scores: dict[str, int] = {}
+        for names in adjacency.values():
+            for name, count in names.items():
+                scores[name] = scores.get(name, 0) + count
+        return scores
+
+    def matching_cells(self, name: str, query: str, prefix: bool = True) -> list[CellLabel]:
+        tokens = tokenize(query)
+        document = self._documents.get(name)
+        if document is None or not tokens:
+            return []
+        *whole, last = tokens
+        result = []
+        for cell in document.labels:
+            if not all(token in cell.terms for token in whole):
+                continue
+            if last in cell.terms or (prefix and any(term.startswith(last) for term in cell.terms)):
+                result.append(cell)
+        return result
+
+    def matching_connections(self, name: str, feeds_from: Optional[str],
+                             feeds_to: Optional[str]) -> list[Connection]:
+        document = self._documents.get(name)
+        if document is None:
+            return []
+        source = label_key(feeds_from) if feeds_from else None
+        target = label_key(feeds_to) if feeds_to else None
+        return [connection for connection in document.connections
+                if (source is None or label_key(connection.source) == source)
+                and (target is None or label_key(connection.target) == target)]
+
+
+def _discard(adjacency: dict[str, dict[str, dict[str, int]]], key: str, other: str, name: str) -> None:
+    names = adjacency[key][other]
+    del names[name]
+    if not names:
+        del adjacency[key][other]
+        if not adjacency[key]:
+            del adjacency[key]
+
+
+_search_index: Optional[SearchIndex] = None
+
+def get_search_index() -> SearchIndex:
+    global _search_index
+    if _search_index is None:
+        _search_index = SearchIndex(get_repository())
+    return _search_index
@@ -0,0 +1,158 @@
+"""
+Seekable gzip: one ordinary gzip member whose deflate stream is cut into
+fixed-size frames, followed by an empty index member (the trick BGZF uses
+for its EOF marker). Every frame is compressed by a fresh compressor and
+ends with a sync flush, so no back-reference crosses a frame boundary and
+each frame starts on a byte boundary. Readers that know the layout can
+inflate any frame on its own; everybody else (``gunzip``, HTTP clients
+that only decode the first member) sees a plain single-member gzip stream.
+
+Layout::
+
+    1f 8b 08 00 ... | frame 0 | frame 1 | ... | 03 00 | crc32 | isize      data member
+    1f 8b 08 04 00000000 00 ff | XLEN | 'I' 'X' LEN | payload | 03 00 | crc=0 | isize=0
+
+    payload = frame_size:u32 total_size:u64 count:u32 offsets:u64*count member_start:u64
+
+Offsets are absolute file positions of the frames; ``member_start`` is the
+position of the index member, and the last 18 bytes of the file always
+contain it.
+"""
+import struct
+import zlib
+from typing import Iterator, Optional
+
+DEFAULT_FRAME_SIZE = 256 * 1024
+
+_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+_INDEX_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff"
+_EMPTY_TAIL = b"\x03\x00" + b"\x00" * 8  # empty deflate block, crc32, isize
+_PAYLOAD_HEAD = struct.Struct("<IQI")
+_OFFSET = struct.Struct("<Q")
+_MAX_PAYLOAD = 0xFFFF - 4
+
+
+def _frame(frame: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # A sync flush ends the frame byte aligned and without a final block
+    return compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def compress(data: bytes, frame_size: int = DEFAULT_FRAME_SIZE, level: int = 6) -> bytes:
+    # Grow the frame size until the index fits into one gzip extra field
+    while _PAYLOAD_HEAD.size + _OFFSET.size * (len(data) // frame_size + 2) > _MAX_PAYLOAD:
+        frame_size *= 2
+
+    parts = [_HEADER]
+    offsets = []
+    position = len(_HEADER)
+    for start in range(0, len(data), frame_size):
+        offsets.append(position)
+        frame = _frame(data[start:start + frame_size], level)
+        parts.append(frame)
+        position += len(frame)
+    # Empty final block and the gzip trailer close the data member
+    parts.append(_EMPTY_TAIL[:2] + struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF))
+    position += len(_EMPTY_TAIL)
+
+    payload = (_PAYLOAD_HEAD.pack(frame_size, len(data), len(offsets))
+               + b"".join(_OFFSET.pack(o) for o in offsets) + _OFFSET.pack(position))
+    extra = b"IX" + struct.pack("<H", len(payload)) + payload
+    parts.append(_INDEX_HEADER + struct.pack("<H", len(extra)) + extra + _EMPTY_TAIL)
+    return b"".join(parts)
+
+
+class FrameIndex:
+    __slots__ = ("frame_size", "size", "offsets", "member_start")
+
+    def __init__(self, frame_size: int, size: int, offsets: list[int], member_start: int):
+        self.frame_size = frame_size
+        self.size = size
+        self.offsets = offsets
+        self.member_start = member_start  # start of the index member, i.e. end of the data member
+
+    @property
+    def end(self) -> int:
+        # End of the last frame: the data member closes with a 2 byte final block and an 8 byte trailer
+        return self.member_start - len(_EMPTY_TAIL)
+
+    @classmethod
+    def read(cls, buffer) -> Optional["FrameIndex"]:
+        """
+        Parses the trailing index of ``buffer`` (bytes or mmap); None if it has none.
+        """
+        if len(buffer) < 18 + len(_INDEX_HEADER):
+            return None
+        (start,) = _OFFSET.unpack(buffer[-18:-10])
+        if buffer[-10:] != _EMPTY_TAIL or start + len(_INDEX_HEADER) + 6 > len(buffer):
+            return None
+        if buffer[start:start + len(_INDEX_HEADER)] != _INDEX_HEADER:
+            return None
+        pos = start + len(_INDEX_HEADER) + 2
+        if buffer[pos:pos + 2] != b"IX":
+            return None
+        pos += 4
+        frame_size, size, count = _PAYLOAD_HEAD.unpack(buffer[pos:pos + _PAYLOAD_HEAD.size])
+        pos += _PAYLOAD_HEAD.size
+        offsets = list(struct.unpack("<%dQ" % count, buffer[pos:pos + 8 * count]))
+        return cls(frame_size, size, offsets, start)
+
+    def frame_bounds(self, index: int) -> tuple[int, int]:
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else self.end
+        return self.offsets[index], end
+
+
+def read_size(buffer) -> Optional[int]:
+    index = FrameIndex.read(buffer)
+    return None if index is None else index.size
+
+
+def _inflate(frame: bytes) -> bytes:
+    return zlib.decompressobj(-15).decompress(frame)
+
+
+def iter_range(buffer, start: int, end: int, index: Optional[FrameIndex] = None) -> Iterator[bytes]:
+    """
+    Yields the uncompressed bytes ``[start, end)``. With an index only the
+    overlapping frames are inflated; without one the stream is inflated from
+    the beginning in bounded chunks.
+    """
+    if start >= end:
+        return
+    if index is None:
+        index = FrameIndex.read(buffer)
+    if index is None:
+        yield from _iter_range_sequential(buffer, start, end)
+        return
+
+    first = start // index.frame_size
+    last = (end - 1) // index.frame_size
+    for i in range(first, min(last, len(index.offsets) - 1) + 1):
+        lo, hi = index.frame_bounds(i)
+        frame = _inflate(buffer[lo:hi])
+        base = i * index.frame_size
+        yield frame[max(start - base, 0):min(end - base, len(frame))]
+
+
+def _iter_range_sequential(buffer, start: int, end: int, chunk: int = 256 * 1024) -> Iterator[bytes]:
+    position = 0
+    offset = 0
+    decompressor = zlib.decompressobj(31)
+    while offset < len(buffer) and position < end:
+        data = decompressor.decompress(buffer[offset:offset + chunk])
+        offset += chunk
+        while decompressor.eof:
+            # Next gzip member
+            rest = decompressor.unused_data
+            decompressor = zlib.decompressobj(31)
+            data += decompressor.decompress(rest) if rest else b""
+            if not rest:
+                break
+        lo, hi = max(start - position, 0), min(end - position, len(data))
+        if lo < hi:
+            yield data[lo:hi]
+        position += len(data)
+
+
+def decompress(buffer) -> bytes:
+    return b"".join(_iter_range_sequential(buffer, 0, 1 << 62))
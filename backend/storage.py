@@ -0,0 +1,466 @@
+"""
+Async diagram storage.
+
+``STORAGE_URL`` selects the backend:
+
+* ``file:data`` / ``file:///srv/diagrams`` - one ``<name>.xml`` file per diagram
+* ``file:data?compression=gzip`` - one seekable ``<name>.xml.gz`` file per diagram
+* ``sqlite:///diagrams.db`` / ``sqlite:////srv/diagrams.db`` - a single SQLite database
+
+Blocking file and database calls run in worker threads so the event loop is
+never held up by disk I/O.
+"""
+import asyncio
+import mmap
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from stat import S_IMODE
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import seekable_gzip
+from config import get_settings
+
+
+# Read once at import: os.umask can only be queried by setting it, which is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+NAME_PATTERN = re.compile(r"^[\w\-]{1,128}$")
+
+
+class InvalidDiagramName(ValueError):
+    pass
+
+
+def check_name(name: str) -> str:
+    if not NAME_PATTERN.match(name):
+        raise InvalidDiagramName("Invalid diagram name %r" % name)
+    return name
+
+
+@dataclass(frozen=True, slots=True)
+class DiagramInfo:
+    name: str
+    size: int
+    modified_ns: int
+
+
+@dataclass(frozen=True, slots=True)
+class StoredDiagram:
+    name: str
+    data: bytes
+    modified_ns: int
+
+    @property
+    def info(self) -> DiagramInfo:
+        return DiagramInfo(self.name, len(self.data), self.modified_ns)
+
+
+class DiagramReader(ABC):
+    """
+    Random access to the uncompressed bytes of one stored diagram. Blocking.
+    """
+
+    encoding: Optional[str] = None  # Content-Encoding of the stored bytes, if they are compressed
+
+    def __init__(self, name: str, size: int, modified_ns: int):
+        self.name = name
+        self.size = size
+        self.modified_ns = modified_ns
+
+    @abstractmethod
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        """
+        Yields the bytes ``[start, end)`` in bounded chunks.
+        """
+
+    @property
+    def stored_size(self) -> int:
+        return self.size
+
+    def iter_stored(self) -> Iterator[bytes]:
+        """
+        Yields the bytes as stored, i.e. in ``encoding`` when that is set.
+        """
+        return self.iter_range(0, self.size)
+
+    def close(self) -> None:
+        pass
+
+
+class BytesReader(DiagramReader):
+
+    def __init__(self, stored: StoredDiagram, chunk_size: int = 256 * 1024):
+        super().__init__(stored.name, len(stored.data), stored.modified_ns)
+        self._view = memoryview(stored.data)
+        self._chunk_size = chunk_size
+
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        for offset in range(start, end, self._chunk_size):
+            yield bytes(self._view[offset:min(offset + self._chunk_size, end)])
+
+
+class MmapReader(DiagramReader):
+    """
+    Serves slices of a memory-mapped file; pages are faulted in on demand.
+    """
+
+    def __init__(self, name: str, fp, chunk_size: int = 256 * 1024):
+        stat = os.fstat(fp.fileno())
+        super().__init__(name, stat.st_size, stat.st_mtime_ns)
+        self._fp = fp
+        self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        self._chunk_size = chunk_size
+
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        for offset in range(start, end, self._chunk_size):
+            yield self._map[offset:min(offset + self._chunk_size, end)]
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._fp.close()
+
+
+class GzipFrameReader(MmapReader):
+    """
+    Serves uncompressed ranges of a memory-mapped seekable gzip file,
+    inflating only the frames a range touches. Its data member is a plain
+    gzip stream and can be sent as-is.
+    """
+    encoding = "gzip"
+
+    def __init__(self, name: str, fp):
+        super().__init__(name, fp)
+        self._index = seekable_gzip.FrameIndex.read(self._map)
+        if self._index is not None:
+            self.size = self._index.size
+        else:
+            # Plain gzip without a frame index: inflate once to learn the size
+            self.size = sum(len(chunk) for chunk in seekable_gzip.iter_range(self._map, 0, 1 << 62))
+
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        return seekable_gzip.iter_range(self._map, start, end, self._index)
+
+    @property
+    def stored_size(self) -> int:
+        # The trailing index member is only useful to us, not to HTTP clients
+        return self._index.member_start if self._index is not None else len(self._map)
+
+    def iter_stored(self) -> Iterator[bytes]:
+        return super().iter_range(0, self.stored_size)
+
+
+class DiagramRepository(ABC):
+
+    @abstractmethod
+    async def get(self, name: str) -> Optional[StoredDiagram]:
+        ...
+
+    @abstractmethod
+    async def put(self, name: str, data: bytes) -> DiagramInfo:
+        ...
+
+    @abstractmethod
+    async def delete(self, name: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def list(self) -> list[DiagramInfo]:
+        ...
+
+    async def open(self, name: str) -> Optional[DiagramReader]:
+        """
+        Opens a diagram for ranged / streamed reads. The caller closes the reader.
+        """
+        stored = await self.get(name)
+        return None if stored is None else BytesReader(stored)
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalDiagramRepository(DiagramRepository):
+    """
+    Diagrams as ``<root>/<name>.xml`` files.
+    """
+    suffix = ".xml"
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+
+    def path(self, name: str) -> Path:
+        return self.root / (check_name(name) + self.suffix)
+
+    def _get(self, name: str) -> Optional[StoredDiagram]:
+        try:
+            with open(self.path(name), "rb") as fp:
+                stat = os.fstat(fp.fileno())
+                data = fp.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        return StoredDiagram(name, data, stat.st_mtime_ns)
+
+    def _put(self, name: str, data: bytes) -> DiagramInfo:
+        path = self.path(name)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Write next to the target and rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".%s." % name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            # mkstemp creates 0600; keep the replaced file's mode, or what open() would have given
+            try:
+                mode = S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                mode = 0o666 & ~_UMASK
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        stat = path.stat()
+        return DiagramInfo(name, stat.st_size, stat.st_mtime_ns)
+
+    def _delete(self, name: str) -> bool:
+        try:
+            self.path(name).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _list(self) -> list[DiagramInfo]:
+        result = []
+        try:
+            with os.scandir(self.root) as it:
+                for item in it:
+                    name = item.name[:-len(self.suffix)]
+                    if item.name.endswith(self.suffix) and NAME_PATTERN.match(name) and item.is_file():
+                        stat = item.stat()
+                        result.append(DiagramInfo(name, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        return result
+
+    def _open(self, name: str) -> Optional[DiagramReader]:
+        try:
+            fp = open(self.path(name), "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        try:
+            return MmapReader(name, fp)
+        except BaseException:
+            fp.close()
+            raise
+
+    async def get(self, name: str) -> Optional[StoredDiagram]:
+        return await asyncio.to_thread(self._get, name)
+
+    async def put(self, name: str, data: bytes) -> DiagramInfo:
+        return await asyncio.to_thread(self._put, name, data)
+
+    async def delete(self, name: str) -> bool:
+        return await asyncio.to_thread(self._delete, name)
+
+    async def list(self) -> list[DiagramInfo]:
+        return await asyncio.to_thread(self._list)
+
+    async def open(self, name: str) -> Optional[DiagramReader]:
+        return await asyncio.to_thread(self._open, name)
+
+
+class CompressedDiagramRepository(LocalDiagramRepository):
+    """
+    Diagrams as seekable ``<root>/<name>.xml.gz`` files. Plain ``<name>.xml``
+    files left in the directory are still read, and are replaced by the
+    compressed form on the next save.
+    """
+    suffix = ".xml.gz"
+
+    def __init__(self, root: str | Path, frame_size: int = seekable_gzip.DEFAULT_FRAME_SIZE):
+        super().__init__(root)
+        self.frame_size = frame_size
+        self._plain = LocalDiagramRepository(root)
+        # name -> (mtime, compressed size, uncompressed size), so listings only open changed files
+        self._sizes: dict[str, tuple[int, int, int]] = {}
+
+    def _get(self, name: str) -> Optional[StoredDiagram]:
+        stored = super()._get(name)
+        if stored is None:
+            return self._plain._get(name)
+        return StoredDiagram(name, seekable_gzip.decompress(stored.data), stored.modified_ns)
+
+    def _put(self, name: str, data: bytes) -> DiagramInfo:
+        info = super()._put(name, seekable_gzip.compress(data, self.frame_size))
+        self._plain._delete(name)
+        return DiagramInfo(name, len(data), info.modified_ns)
+
+    def _delete(self, name: str) -> bool:
+        deleted = super()._delete(name)
+        return self._plain._delete(name) or deleted
+
+    def _list(self) -> list[DiagramInfo]:
+        result = {info.name: info for info in self._plain._list()}
+        known, sizes = self._sizes, {}
+        for info in super()._list():
+            cached = known.get(info.name)
+            if cached is not None and cached[:2] == (info.modified_ns, info.size):
+                size = cached[2]
+            else:
+                try:
+                    size = self._read_size(info)
+                except FileNotFoundError:
+                    continue
+            sizes[info.name] = (info.modified_ns, info.size, size)
+            result[info.name] = DiagramInfo(info.name, size, info.modified_ns)
+        self._sizes = sizes
+        return list(result.values())
+
+    def _read_size(self, info: DiagramInfo) -> int:
+        # Report the uncompressed size; mapping the file only pages in the index at its end
+        if not info.size:
+            return 0
+        with open(self.path(info.name), "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = seekable_gzip.read_size(mapped)
+        return size if size is not None else info.size
+
+    def _open(self, name: str) -> Optional[DiagramReader]:
+        try:
+            fp = open(self.path(name), "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            return self._plain._open(name)
+        try:
+            return GzipFrameReader(name, fp)
+        except BaseException:
+            fp.close()
+            raise
+
+
+class _ConnectionPool:
+    """
+    Fixed set of SQLite connections shared by worker threads.
+    """
+
+    def __init__(self, path: str, size: int):
+        self._idle: queue.Queue[sqlite3.Connection] = queue.Queue()
+        self._all = []
+        for _ in range(size):
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._all.append(conn)
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        for conn in self._all:
+            conn.close()
+
+
+class SQLiteDiagramRepository(DiagramRepository):
+
+    def __init__(self, path: str, pool_size: int = 4):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        else:
+            # Every :memory: connection is a separate database
+            pool_size = 1
+        self._pool = _ConnectionPool(path, pool_size)
+        with self._pool.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS diagrams ("
+                " name TEXT PRIMARY KEY,"
+                " data BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " modified_ns INTEGER NOT NULL)"
+            )
+
+    def _get(self, name: str) -> Optional[StoredDiagram]:
+        with self._pool.connection() as conn:
+            row = conn.execute("SELECT data, modified_ns FROM diagrams WHERE name = ?", (name,)).fetchone()
+        return None if row is None else StoredDiagram(name, bytes(row[0]), row[1])
+
+    def _put(self, name: str, data: bytes) -> DiagramInfo:
+        info = DiagramInfo(name, len(data), time.time_ns())
+        with self._pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO diagrams (name, data, size, modified_ns) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET data = excluded.data, size = excluded.size,"
+                " modified_ns = excluded.modified_ns",
+                (name, data, info.size, info.modified_ns),
+            )
+        return info
+
+    def _delete(self, name: str) -> bool:
+        with self._pool.connection() as conn:
+            return conn.execute("DELETE FROM diagrams WHERE name = ?", (name,)).rowcount > 0
+
+    def _list(self) -> list[DiagramInfo]:
+        with self._pool.connection() as conn:
+            rows = conn.execute("SELECT name, size, modified_ns FROM diagrams ORDER BY name").fetchall()
+        return [DiagramInfo(*row) for row in rows]
+
+    async def get(self, name: str) -> Optional[StoredDiagram]:
+        return await asyncio.to_thread(self._get, check_name(name))
+
+    async def put(self, name: str, data: bytes) -> DiagramInfo:
+        return await asyncio.to_thread(self._put, check_name(name), data)
+
+    async def delete(self, name: str) -> bool:
+        return await asyncio.to_thread(self._delete, check_name(name))
+
+    async def list(self) -> list[DiagramInfo]:
+        return await asyncio.to_thread(self._list)
+
+    async def close(self) -> None:
+        self._pool.close()
+
+
+def create_repository(url: str, pool_size: int = 4) -> DiagramRepository:
+    """
+    Builds a repository from a storage URL; a bare path means a local directory.
+    """
+    parts = urlsplit(url)
+    if len(parts.scheme) <= 1:
+        # Plain path, including Windows drive letters
+        return LocalDiagramRepository(url)
+    if parts.scheme == "file":
+        # file:data -> "data", file:///srv/data -> "/srv/data"
+        root = parts.netloc + parts.path
+        compression = parse_qs(parts.query).get("compression", [""])[0]
+        if compression == "gzip":
+            return CompressedDiagramRepository(root)
+        if compression:
+            raise ValueError("Unsupported compression %r" % compression)
+        return LocalDiagramRepository(root)
+    if parts.scheme == "sqlite":
+        # sqlite:///rel.db -> "rel.db", sqlite:////abs.db -> "/abs.db"
+        path = parts.path[1:] if parts.path.startswith("/") else parts.path
+        return SQLiteDiagramRepository(path or ":memory:", pool_size)
+    raise ValueError("Unsupported storage URL %r" % url)
+
+
+_repository: Optional[DiagramRepository] = None
+
+def get_repository() -> DiagramRepository:
+    global _repository
+    if _repository is None:
+        settings = get_settings()
+        _repository = create_repository(settings.STORAGE_URL, settings.STORAGE_POOL_SIZE)
+    return _repository
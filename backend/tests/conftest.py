@@ -0,0 +1,35 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+import config
+import diagram_cache
+import diagram_versions
+import search_index
+import storage
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+
+@pytest.fixture
+def storage_dir(tmp_path, monkeypatch):
+    """
+    A copy of data/ used as STORAGE_URL, with every module singleton reset.
+    """
+    for fixture in DATA_DIR.glob("*.xml"):
+        shutil.copy(fixture, tmp_path)
+    monkeypatch.setenv("STORAGE_URL", "file:" + str(tmp_path))
+    for module, name in ((config, "_settings"), (storage, "_repository"), (diagram_cache, "_diagram_cache"),
+                         (diagram_versions, "_diagram_versions"), (search_index, "_search_index")):
+        monkeypatch.setattr(module, name, None)
+    return tmp_path
+
+
+@pytest.fixture
+def client(storage_dir):
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+
+@pytest.mark.parametrize("body", [
+    b"<mxfile",
+    b'<root><mxCell id="1"/></root>',
+    b'<mxfile><diagram><root><mxCell id="1"/></root></diagram></mxfile>',
+    b'<mxfile><diagram>AAAA</diagram></mxfile>',
+])
+def test_put_rejects_invalid_diagrams(client, storage_dir, body):
+    response = client.put("/api/v1/diagrams/broken", content=body)
+
+    assert response.status_code == 422
+    assert not (storage_dir / "broken.xml").exists()
+
+
+def test_put_then_get(client):
+    body = b'<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/></root></mxGraphModel>'
+    assert client.put("/api/v1/diagrams/new", content=body).json()["size"] == len(body)
+
+    response = client.get("/api/v1/diagrams/new", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.content == body
+
+
+def _arrows(count: int) -> bytes:
+    cells = ['<mxCell id="0"/>', '<mxCell id="a" value="Order" vertex="1" parent="0"/>',
+             '<mxCell id="b" value="Invoice" vertex="1" parent="0"/>']
+    cells += ['<mxCell id="e%d" edge="1" source="a" target="b" parent="0"/>' % i for i in range(count)]
+    return ("<mxGraphModel><root>%s</root></mxGraphModel>" % "".join(cells)).encode()
+
+
+def test_edge_search_ranks_by_arrow_count(client):
+    client.put("/api/v1/diagrams/aaa_one_arrow", content=_arrows(1))
+    client.put("/api/v1/diagrams/zzz_three_arrows", content=_arrows(3))
+
+    response = client.get("/api/v1/search", params={"feeds_from": "order", "limit": 1})
+
+    assert response.status_code == 200
+    [hit] = response.json()["hits"]
+    assert (hit["name"], hit["score"], len(hit["connections"])) == ("zzz_three_arrows", 3, 3)
+
+
+def test_shutdown_waits_for_the_storage_watcher(storage_dir, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    import storage
+    from main import app
+
+    repository = storage.get_repository()
+    events = []
+    list_ = repository._list
+
+    def slow_list():
+        time.sleep(0.2)
+        events.append("listed")
+        return list_()
+
+    async def close():
+        events.append("closed")
+
+    monkeypatch.setattr(repository, "_list", slow_list)
+    monkeypatch.setattr(repository, "close", close)
+    with TestClient(app):
+        time.sleep(0.05)
+
+    assert events[-2:] == ["listed", "closed"]
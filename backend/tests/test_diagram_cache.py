@@ -0,0 +1,38 @@
+import asyncio
+
+from diagram_cache import DiagramCache
+from storage import LocalDiagramRepository
+
+
+def _body(i: int) -> bytes:
+    return ('<mxGraphModel><root><mxCell id="0"/><mxCell id="%d" value="%s"/></root></mxGraphModel>'
+            % (i, "x" * 1000)).encode()
+
+
+def test_lru_respects_total_budget_and_pins_warmed(tmp_path):
+    repository = LocalDiagramRepository(tmp_path)
+    for i in range(10):
+        repository._put("d%d" % i, _body(i))
+    cache = DiagramCache(repository, max_bytes=10_000, total_bytes=4_000)
+
+    async def scenario():
+        await cache.warm(["d0"])
+        for i in range(1, 10):
+            assert await cache.load("d%d" % i) is not None
+            assert cache.bytes <= cache.total_bytes or len(cache) == 1
+        # The most recently used unpinned entry survives, the pinned one is never evicted
+        assert cache.get("d0") is not None
+        assert cache.get("d9") is not None
+        assert cache.get("d1") is None
+        assert cache.evictions > 0
+
+    asyncio.run(scenario())
+
+
+def test_oversized_diagrams_are_not_cached(tmp_path):
+    repository = LocalDiagramRepository(tmp_path)
+    repository._put("big", _body(1))
+    cache = DiagramCache(repository, max_bytes=100, total_bytes=10_000)
+
+    assert asyncio.run(cache.load("big")) is None
+    assert cache.bytes == 0
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+import mxgraph
+from diagram_versions import DiagramVersions, PatchError, VersionedDiagram, VersionTooOld
+from schemas import SCellChange
+from storage import LocalDiagramRepository
+
+BODY = (b'<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>'
+        b'<mxCell id="a" value="A" vertex="1" parent="1"/><mxCell id="b" value="B" vertex="1" parent="1"/>'
+        b'<mxCell id="e" edge="1" parent="1" source="a" target="b"/></root></mxGraphModel>')
+
+
+def _document(history_limit: int = 100) -> VersionedDiagram:
+    return VersionedDiagram(mxgraph.parse(BODY), history_limit, "epoch")
+
+
+def _change(op: str, id: str, **fields) -> SCellChange:
+    return SCellChange(op=op, id=id, **fields)
+
+
+def test_diff_reports_net_changes():
+    document = _document()
+    document.apply([_change("add", "c", value="C", vertex=True, parent="1")])
+    document.apply([_change("update", "c", value="C2"), _change("update", "a", value="A2")])
+    document.apply([_change("update", "e", target="c"), _change("remove", "b")])
+
+    diff = document.diff(1)
+    assert (diff.epoch, diff.version, diff.since) == ("epoch", 3, 1)
+    assert {(c.op.value, c.id, c.value) for c in diff.changes} == {
+        ("update", "c", "C2"), ("update", "a", "A2"), ("update", "e", None), ("remove", "b", None)}
+    # Added after the client's version, so it is sent as an add with its current state
+    assert [(c.op.value, c.value) for c in document.diff(0).changes if c.id == "c"] == [("add", "C2")]
+
+
+@pytest.mark.parametrize("changes", [
+    [_change("add", "a")],
+    [_change("update", "x", value="X")],
+    [_change("add", "c", parent="missing")],
+    [_change("update", "e", source="missing")],
+    [_change("remove", "b")],
+    [_change("remove", "1")],
+    [_change("remove", "b"), _change("update", "e", value="still pointing at b")],
+])
+def test_invalid_patches_leave_the_document_untouched(changes):
+    document = _document()
+    before = mxgraph.dumps(document.document)
+
+    with pytest.raises(PatchError):
+        document.apply(changes)
+    assert mxgraph.dumps(document.document) == before
+    assert document.version == 0
+
+
+def test_removing_a_cell_with_its_referrers():
+    document = _document()
+
+    document.apply([_change("remove", "e"), _change("remove", "b")])
+    assert set(document.document.diagrams[0].cells) == {"0", "1", "a"}
+    with pytest.raises(PatchError):
+        document.apply([_change("remove", "1")])
+
+
+def test_trim_keeps_the_patch_base():
+    document = _document(history_limit=2)
+    for i in range(3):
+        document.apply([_change("update", "a", value=str(i))])
+
+    document.check_base("epoch", 2)
+    with pytest.raises(VersionTooOld):
+        document.check_base("epoch", 0)
+    with pytest.raises(VersionTooOld):
+        document.check_base("other", 3)
+    # A large patch from an old base still returns its diff
+    document.apply([_change("update", "a", value="x"), _change("update", "b", value="y"),
+                    _change("update", "e", value="z")], keep=2)
+    assert {c.id for c in document.diff(2).changes} == {"a", "b", "e"}
+
+
+def test_write_back_and_storage_changes(tmp_path):
+    repository = LocalDiagramRepository(tmp_path)
+    repository._put("d", BODY)
+    versions = DiagramVersions(repository, 100, max_documents=1, flush_delay=0)
+
+    async def scenario():
+        document = await versions.get("d")
+        document.apply([_change("update", "a", value="Edited")])
+        versions.changed("d")
+        await asyncio.sleep(0.05)
+        assert b'value="Edited"' in repository._get("d").data
+        assert not document.dirty
+
+        # Its own write is not mistaken for a change in storage
+        assert await versions.refresh(repository._list()) == []
+        assert await versions.get("d") is document
+
+        repository._put("d", BODY.replace(b'"A"', b'"Replaced"'))
+        assert await versions.refresh(repository._list()) == ["d"]
+        reloaded = await versions.get("d")
+        assert reloaded.epoch != document.epoch
+
+        # Saved documents beyond the limit are dropped
+        repository._put("other", BODY)
+        await versions.get("other")
+        assert len(versions) == 1
+
+    asyncio.run(scenario())
+
+
+def test_patch_api(client, storage_dir):
+    response = client.get("/api/v1/diagram/simple/versioned")
+    epoch, version = response.headers["X-Diagram-Epoch"], int(response.headers["X-Diagram-Version"])
+
+    patch = {"epoch": epoch, "base_version": version,
+             "changes": [{"op": "update", "id": "id1TdpJ1bZ5UunfHk-E--3", "value": "Patched"}]}
+    response = client.post("/api/v1/diagram/simple/patch", json=patch)
+    assert response.status_code == 200
+    assert response.json()["version"] == version + 1
+
+    # Replacing the stored diagram invalidates the client's epoch
+    assert client.put("/api/v1/diagrams/simple", content=BODY).status_code == 200
+    response = client.get("/api/v1/diagram/simple/patch", params={"epoch": epoch, "since": version})
+    assert response.status_code == 409
+    response = client.post("/api/v1/diagram/simple/patch", json={**patch, "changes": []})
+    assert response.status_code == 409
+    assert b"Patched" not in (storage_dir / "simple.xml").read_bytes()
+
+
+@pytest.mark.parametrize("body", [b"<mxfile></mxfile>", b"<mxfile"])
+def test_uneditable_stored_diagrams(client, storage_dir, body):
+    (storage_dir / "odd.xml").write_bytes(body)
+
+    assert client.get("/api/v1/diagram/odd/versioned").status_code == 409
@@ -0,0 +1,89 @@
+import asyncio
+import base64
+import io
+import json
+import zipfile
+
+import pytest
+
+from export import create_pool, export_batch
+from schemas import ExportContainerEnum, ExportFormatEnum
+from storage import LocalDiagramRepository
+
+
+@pytest.fixture(scope="module")
+def pool():
+    with create_pool(1) as executor:
+        yield executor
+
+
+async def _collect(chunks) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+def test_bad_items_do_not_abort_the_batch(storage_dir, pool):
+    repository = LocalDiagramRepository(storage_dir)
+    names = ["bad/name", "simple", "missing"]
+
+    body = asyncio.run(_collect(export_batch(names, ExportFormatEnum.xml, ExportContainerEnum.zip,
+                                             repository, pool, window=2)))
+
+    archive = zipfile.ZipFile(io.BytesIO(body))
+    assert sorted(archive.namelist()) == ["bad/name.error.txt", "missing.error.txt", "simple.xml"]
+    assert b"InvalidDiagramName" in archive.read("bad/name.error.txt")
+
+
+def test_ndjson_errors(storage_dir, pool):
+    repository = LocalDiagramRepository(storage_dir)
+
+    body = asyncio.run(_collect(export_batch(["simple", "missing"], ExportFormatEnum.json,
+                                             ExportContainerEnum.ndjson, repository, pool, window=2)))
+
+    lines = {line["name"]: line for line in map(json.loads, body.splitlines())}
+    assert lines["missing"] == {"name": "missing", "error": "not found"}
+    assert lines["simple"]["cells"]
+
+
+def test_ndjson_non_utf8_xml(storage_dir, pool):
+    latin = '<?xml version="1.0" encoding="ISO-8859-1"?><mxGraphModel><root><mxCell id="0" value="Café"/></root></mxGraphModel>'
+    (storage_dir / "latin.xml").write_bytes(latin.encode("iso-8859-1"))
+    repository = LocalDiagramRepository(storage_dir)
+
+    body = asyncio.run(_collect(export_batch(["latin", "simple"], ExportFormatEnum.xml,
+                                             ExportContainerEnum.ndjson, repository, pool, window=2)))
+
+    lines = {line["name"]: line for line in map(json.loads, body.splitlines())}
+    [latin_file] = lines["latin"]["files"]
+    assert latin_file["encoding"] == "base64"
+    assert base64.b64decode(latin_file["data"]) == latin.encode("iso-8859-1")
+    assert lines["simple"]["files"][0]["data"].startswith("<mxfile")
+
+
+class _SlowRepository:
+    def __init__(self, inner):
+        self.inner = inner
+        self.cancelled = 0
+
+    async def get(self, name):
+        if name != "simple":
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        return await self.inner.get(name)
+
+
+def test_closing_the_stream_cancels_pending_items(storage_dir, pool):
+    repository = _SlowRepository(LocalDiagramRepository(storage_dir))
+
+    async def scenario():
+        chunks = export_batch(["simple", "a", "b", "c"], ExportFormatEnum.xml, ExportContainerEnum.ndjson,
+                              repository, pool, window=4)
+        first = await chunks.__anext__()
+        await chunks.aclose()
+        await asyncio.sleep(0)
+        return first
+
+    assert b'"simple"' in asyncio.run(scenario())
+    assert repository.cancelled == 3
@@ -0,0 +1,42 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+pytest.importorskip("httpx")
+
+from http_bench import compare, in_process_client, measure, percentile  # noqa: E402
+
+
+@pytest.mark.parametrize("n, q, rank", [(500, 99, 495), (500, 50, 250), (100, 99, 99), (1, 99, 1), (3, 50, 2)])
+def test_percentile_is_nearest_rank(n, q, rank):
+    assert percentile(list(range(1, n + 1)), q) == rank
+
+
+def _result(errors: int, p50: float) -> dict:
+    return {"results": {"health": {"errors": errors, "p50_ms": p50, "p99_ms": p50, "rps": 1000 / p50}}}
+
+
+def test_compare_flags_new_errors_even_when_faster():
+    regressions = compare(_result(errors=3, p50=1.0), _result(errors=0, p50=2.0), threshold=0.1)
+
+    assert regressions == ["health errors: 0 -> 3"]
+
+
+def test_compare_flags_slowdowns():
+    assert len(compare(_result(0, 2.0), _result(0, 1.0), threshold=0.1)) == 3
+    assert compare(_result(0, 1.05), _result(0, 1.0), threshold=0.1) == []
+
+
+def test_bytes_per_request_counts_the_wire(storage_dir):
+    async def scenario():
+        async with in_process_client(storage_dir) as client:
+            path = "/api/v1/diagrams/complex"
+            return (await measure(client, path, 2, 1, {"Accept-Encoding": "gzip"}),
+                    await measure(client, path, 2, 1, {"Accept-Encoding": "identity"}))
+
+    gzipped, identity = asyncio.run(scenario())
+    assert gzipped["decoded_bytes_per_request"] == identity["bytes_per_request"]
+    assert gzipped["bytes_per_request"] < identity["bytes_per_request"]
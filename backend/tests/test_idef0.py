@@ -0,0 +1,76 @@
+import pytest
+from pydantic import ValidationError
+
+import mxgraph
+from idef0 import LayoutCache, generate, layout_level
+from schemas import SDecompositionLevel, SIDEF0Model
+
+
+def _level(**fields) -> dict:
+    return {"activities": [{"id": "a", "name": "Receive"}, {"id": "b", "name": "Ship"}],
+            "arrows": [{"kind": "input", "source": "a", "target": "b"}], **fields}
+
+
+def test_parent_activity_sets_node():
+    model = SIDEF0Model(levels=[_level(), _level(parent_activity="b")])
+
+    assert model.levels[1].node == "A2"
+    assert model.levels[1].child_number(1) == "A21"
+
+
+@pytest.mark.parametrize("levels", [
+    [_level(parent_activity="a")],
+    [_level(), _level(parent_activity="x")],
+    [_level(), _level(parent_activity="a", node="A3")],
+    [_level(), _level(parent_activity="a"), _level(parent_activity="a")],
+])
+def test_invalid_parent_activity(levels):
+    with pytest.raises(ValidationError):
+        SIDEF0Model(levels=levels)
+
+
+def test_identical_levels_share_a_layout():
+    cache = LayoutCache(maxsize=8)
+    model = SIDEF0Model(levels=[_level(node="A1", title="Same"), _level(node="A1", title="Same")])
+
+    digest, xml = generate(model, cache)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert [d.id for d in mxgraph.parse(xml.encode()).diagrams] == ["A1-0", "A1-1"]
+    assert generate(model, cache)[0] == digest
+
+
+def test_cell_ids_do_not_collide():
+    level = {"activities": [{"id": "a", "name": "A"}, {"id": "a-number", "name": "B"}],
+             "arrows": [{"id": "1", "kind": "input", "source": "a", "target": "a-number"},
+                        {"kind": "control", "target": "a"}, {"kind": "output", "source": "a-number"}]}
+
+    [diagram] = mxgraph.parse(generate(SIDEF0Model(levels=[level]), LayoutCache(maxsize=8))[1].encode()).diagrams
+
+    assert sum(cell.vertex for cell in diagram.cells.values()) == 4
+    assert sum(cell.edge for cell in diagram.cells.values()) == 3
+
+
+def test_duplicate_arrow_ids_are_rejected():
+    with pytest.raises(ValidationError):
+        SIDEF0Model(levels=[_level(arrows=[{"id": "1", "kind": "input", "target": "a"},
+                                           {"id": "1", "kind": "input", "target": "b"}])])
+
+
+def test_boundary_arrows_avoid_other_boxes():
+    activities = [{"id": "b%d" % i, "name": str(i)} for i in range(14)]
+    arrows = [{"kind": kind, "target": a["id"]} for a in activities for kind in ("control", "mechanism")]
+    diagram = layout_level(SDecompositionLevel(activities=activities, arrows=arrows))
+
+    boxes = {cell.id: cell.geometry for cell in diagram.cells.values() if cell.vertex and cell.parent == "1"}
+    for edge in (cell for cell in diagram.cells.values() if cell.edge):
+        target = boxes[edge.target]
+        points = [edge.geometry.source_point] + edge.geometry.points
+        path = [(p.x, p.y) for p in points]
+        entry_y = target.y if path[-1][1] < target.y else target.y + target.height
+        path.append((path[-1][0], entry_y))
+        for (ax, ay), (bx, by) in zip(path, path[1:]):
+            for cell_id, box in boxes.items():
+                crosses = (min(ax, bx) < box.x + box.width and max(ax, bx) > box.x
+                           and min(ay, by) < box.y + box.height and max(ay, by) > box.y)
+                assert not crosses, (edge.id, cell_id)
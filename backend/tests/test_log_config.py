@@ -0,0 +1,26 @@
+import json
+import logging
+import queue
+
+from log_config import DeferredQueueHandler, JsonFormatter
+
+
+def test_records_are_queued_unformatted_with_exc_info():
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("tests.deferred")
+    logger.propagate = False
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    try:
+        raise ZeroDivisionError("boom")
+    except ZeroDivisionError:
+        logger.exception("failed %s", "job", extra={"variant": "simple"})
+
+    record = log_queue.get_nowait()
+    assert record.args == ("job",)
+    assert record.exc_info[0] is ZeroDivisionError
+
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["msg"] == "failed job"
+    assert entry["variant"] == "simple"
+    assert "ZeroDivisionError: boom" in entry["exc"]
+    assert "Traceback" not in entry["msg"]
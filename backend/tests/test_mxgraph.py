@@ -0,0 +1,53 @@
+import base64
+import zlib
+from pathlib import Path
+from urllib.parse import quote
+
+import pytest
+
+import mxgraph
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+
+def _compressed_page(xml: str) -> str:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    data = compressor.compress(quote(xml).encode("ascii")) + compressor.flush()
+    return base64.b64encode(data).decode("ascii")
+
+
+@pytest.mark.parametrize("path", sorted(DATA_DIR.glob("*.xml")), ids=lambda p: p.stem)
+def test_fixtures_round_trip(path):
+    original = mxgraph.parse(str(path))
+    again = mxgraph.parse(mxgraph.dumps(original).encode("utf-8"))
+
+    assert [d.id for d in again.diagrams] == [d.id for d in original.diagrams]
+    for before, after in zip(original.diagrams, again.diagrams):
+        assert list(after.cells) == list(before.cells)
+        assert [c.label for c in after.cells.values()] == [c.label for c in before.cells.values()]
+
+
+def test_bare_graph_model():
+    mxfile = mxgraph.parse(b'<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/></root></mxGraphModel>')
+
+    assert mxfile.attrs is None
+    assert list(mxfile.diagrams[0].cells) == ["0", "1"]
+
+
+def test_compressed_page():
+    page = '<mxGraphModel><root><mxCell id="0"/><mxCell id="2" value="Блок" vertex="1" parent="0"/></root></mxGraphModel>'
+    mxfile = mxgraph.parse(('<mxfile><diagram id="p">%s</diagram></mxfile>' % _compressed_page(page)).encode())
+
+    assert mxfile.diagrams[0].id == "p"
+    assert mxfile.diagrams[0].cells["2"].label == "Блок"
+
+
+@pytest.mark.parametrize("body", [
+    b'<root><mxCell id="1"/></root>',
+    b'<mxfile><diagram><root><mxCell id="1"/></root></diagram></mxfile>',
+    b'<mxfile><diagram>AAAA</diagram></mxfile>',
+    b'<svg/>',
+])
+def test_invalid_documents_raise_value_error(body):
+    with pytest.raises(ValueError):
+        mxgraph.parse(body)
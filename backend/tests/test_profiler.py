@@ -0,0 +1,32 @@
+import queue
+import threading
+import time
+
+from profiler import SamplingProfiler
+
+
+def _busy(deadline: float) -> None:
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def test_idle_threads_are_not_charged_to_slow_requests():
+    idle = queue.Queue()
+    waiter = threading.Thread(target=idle.get, daemon=True)
+    waiter.start()
+    profiler = SamplingProfiler(interval=0.002, slow_threshold=0.05)
+    profiler.start()
+    try:
+        start = time.perf_counter()
+        worker = threading.Thread(target=_busy, args=(start + 0.2,))
+        worker.start()
+        worker.join()
+        profiler.request_finished("GET", "/slow", start, time.perf_counter())
+    finally:
+        profiler.stop()
+        idle.put(None)
+
+    lines = profiler.folded().splitlines()
+    assert lines
+    assert all("_busy" in line for line in lines if "test_profiler.py" in line)
+    assert not any("wait (threading.py" in line.rsplit(";", 1)[-1] for line in lines)
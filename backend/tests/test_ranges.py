@@ -0,0 +1,119 @@
+import gzip
+
+import pytest
+from fastapi import HTTPException
+
+from main import parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 100)),
+    ("bytes=100-", (100, 1000)),
+    ("bytes=-50", (950, 1000)),
+    ("bytes=-5000", (0, 1000)),
+    ("bytes=990-5000", (990, 1000)),
+    ("bytes=999-999", (999, 1000)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=0-1,5-6", "bytes=abc", "items=0-1", "bytes=5-1", "bytes=5"])
+def test_parse_range_ignores_unsupported(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5000-6000", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(HTTPException) as e:
+        parse_range(header, 1000)
+    assert e.value.status_code == 416
+    assert e.value.headers["Content-Range"] == "bytes */1000"
+
+
+@pytest.fixture(params=["", "?compression=gzip"], ids=["plain", "gzip"])
+def large_client(request, storage_dir, monkeypatch):
+    from fastapi.testclient import TestClient
+    from main import app
+
+    monkeypatch.setenv("STORAGE_URL", "file:%s%s" % (storage_dir, request.param))
+    monkeypatch.setenv("CACHE_MAX_BYTES", "1024")
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def large_body():
+    cells = "".join('<mxCell id="c%d" value="Блок %d" vertex="1" parent="1"/>' % (i, i) for i in range(5000))
+    return ('<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>%s</root></mxGraphModel>'
+            % cells).encode("utf-8")
+
+
+def test_large_diagram_ranges(large_client, large_body):
+    large_client.put("/api/v1/diagrams/large", content=large_body)
+    identity = {"Accept-Encoding": "identity"}
+
+    full = large_client.get("/api/v1/diagrams/large", headers=identity)
+    assert full.status_code == 200
+    assert full.content == large_body
+    assert full.headers["accept-ranges"] == "bytes"
+
+    part = large_client.get("/api/v1/diagrams/large", headers={**identity, "Range": "bytes=1000-200000"})
+    assert part.status_code == 206
+    assert part.content == large_body[1000:200001]
+    assert part.headers["content-range"] == "bytes 1000-200000/%d" % len(large_body)
+
+    missing = large_client.get("/api/v1/diagrams/large", headers={"Range": "bytes=%d-" % len(large_body)})
+    assert missing.status_code == 416
+
+    stale = large_client.get("/api/v1/diagrams/large", headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+    assert stale.status_code == 200
+
+
+def test_large_diagram_gzip(large_client, large_body):
+    large_client.put("/api/v1/diagrams/large", content=large_body)
+
+    response = large_client.get("/api/v1/diagrams/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"].endswith('-gzip"')
+    # httpx decodes the body; the wire size must be the compressed one
+    assert len(response.content) == len(large_body)
+    assert int(response.headers.get("content-length", 0)) < len(large_body) / 3 or \
+        "content-length" not in response.headers
+
+    revalidated = large_client.get("/api/v1/diagrams/large",
+                                   headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304
+
+    ranged = large_client.get("/api/v1/diagrams/large", headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+    assert "content-encoding" not in ranged.headers
+    assert ranged.content == large_body[:10]
+
+
+def test_stored_gzip_is_sent_as_is(storage_dir, monkeypatch, large_body):
+    from fastapi.testclient import TestClient
+    from main import app
+
+    monkeypatch.setenv("STORAGE_URL", "file:%s?compression=gzip" % storage_dir)
+    monkeypatch.setenv("CACHE_MAX_BYTES", "1024")
+    with TestClient(app) as client:
+        client.put("/api/v1/diagrams/large", content=large_body)
+        with client.stream("GET", "/api/v1/diagrams/large", headers={"Accept-Encoding": "gzip"}) as response:
+            raw = b"".join(response.iter_raw())
+
+    stored = (storage_dir / "large.xml.gz").read_bytes()
+    assert stored.startswith(raw) and len(raw) < len(stored)
+    assert gzip.decompress(raw) == large_body
+
+
+def test_large_diagram_if_modified_since(large_client, large_body):
+    large_client.put("/api/v1/diagrams/large", content=large_body)
+
+    future = large_client.get("/api/v1/diagrams/large", headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+    assert future.status_code == 304
+    past = large_client.get("/api/v1/diagrams/large", headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+    assert past.status_code == 200
+    # If-None-Match takes precedence
+    stale = large_client.get("/api/v1/diagrams/large", headers={
+        "If-None-Match": '"old"', "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+    assert stale.status_code == 200
@@ -0,0 +1,22 @@
+import asyncio
+
+from search_index import SearchIndex, label_text, tokenize
+from storage import LocalDiagramRepository
+
+
+def test_tokenize_cyrillic_and_html():
+    assert tokenize(label_text("Приём&nbsp;<b>Заказа</b>")) == ["прием", "заказа"]
+
+
+def test_refresh_skips_unparseable_diagrams(storage_dir):
+    (storage_dir / "aaa_bad.xml").write_bytes(b'<root><mxCell id="1"/></root>')
+    (storage_dir / "aab_broken.xml").write_bytes(b'<mxfile><diagram>AAAA</diagram></mxfile>')
+    index = SearchIndex(LocalDiagramRepository(storage_dir))
+
+    changed = asyncio.run(index.refresh())
+
+    assert {"aaa_bad", "aab_broken", "simple"} <= set(changed)
+    assert len(index) == len(list(storage_dir.glob("*.xml"))) - 2
+    assert "simple" in index.match_text("квадрат")
+    # Failed documents are not retried until they change
+    assert asyncio.run(index.refresh()) == []
@@ -0,0 +1,76 @@
+import gzip
+import os
+import random
+import zlib
+
+import pytest
+
+import seekable_gzip
+
+
+@pytest.fixture(scope="module")
+def payload():
+    rng = random.Random(7)
+    words = [b"<mxCell", b'id="', b"vertex", b"edge", "Блок".encode(), b"\n"]
+    return b" ".join(rng.choice(words) for _ in range(200_000))
+
+
+def test_compressed_file_is_plain_gzip(payload):
+    data = seekable_gzip.compress(payload, frame_size=64 * 1024)
+
+    assert gzip.decompress(data) == payload
+    assert seekable_gzip.decompress(data) == payload
+
+
+def test_index(payload):
+    data = seekable_gzip.compress(payload, frame_size=64 * 1024)
+    index = seekable_gzip.FrameIndex.read(data)
+
+    assert index.size == len(payload) == seekable_gzip.read_size(data)
+    assert index.frame_size == 64 * 1024
+    assert len(index.offsets) == -(-len(payload) // index.frame_size)
+    lo, hi = index.frame_bounds(1)
+    assert zlib.decompressobj(-15).decompress(data[lo:hi]) == payload[64 * 1024:128 * 1024]
+
+
+def test_data_member_alone_is_complete(payload):
+    data = seekable_gzip.compress(payload, frame_size=64 * 1024)
+    index = seekable_gzip.FrameIndex.read(data)
+    # Decoders that stop after the first gzip member still get everything
+    decompressor = zlib.decompressobj(31)
+    assert decompressor.decompress(data) == payload
+    assert decompressor.eof and len(decompressor.unused_data) == len(data) - index.member_start
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_iter_range(payload, indexed):
+    data = seekable_gzip.compress(payload, frame_size=64 * 1024)
+    if not indexed:
+        data = gzip.compress(payload)
+    rng = random.Random(1)
+    spans = [(0, 1), (0, len(payload)), (64 * 1024 - 1, 64 * 1024 + 1), (len(payload) - 5, len(payload) + 100)]
+    spans += [tuple(sorted(rng.randrange(len(payload)) for _ in range(2))) for _ in range(20)]
+
+    for start, end in spans:
+        assert b"".join(seekable_gzip.iter_range(data, start, end)) == payload[start:end]
+
+
+def test_plain_gzip_has_no_index():
+    assert seekable_gzip.FrameIndex.read(gzip.compress(b"x" * 1000)) is None
+
+
+@pytest.mark.parametrize("payload", [b"", b"a", os.urandom(3 * 1024)])
+def test_small_payloads(payload):
+    data = seekable_gzip.compress(payload, frame_size=1024)
+
+    assert gzip.decompress(data) == payload
+    assert seekable_gzip.read_size(data) == len(payload)
+    assert b"".join(seekable_gzip.iter_range(data, 0, len(payload))) == payload
+
+
+def test_frame_size_grows_to_fit_index():
+    payload = os.urandom(64 * 1024)
+    data = seekable_gzip.compress(payload, frame_size=1)
+
+    assert seekable_gzip.FrameIndex.read(data).frame_size > 1
+    assert gzip.decompress(data) == payload
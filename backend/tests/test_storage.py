@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+import storage
+from storage import CompressedDiagramRepository, LocalDiagramRepository
+
+
+def test_compressed_listing_reuses_sizes(tmp_path, monkeypatch):
+    repository = CompressedDiagramRepository(tmp_path)
+    repository._put("a", b"<mxGraphModel/>" * 100)
+    assert [info.size for info in repository._list()] == [1500]
+
+    def fail(info):
+        raise AssertionError("unchanged file reopened")
+    monkeypatch.setattr(repository, "_read_size", fail)
+    assert [info.size for info in repository._list()] == [1500]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="POSIX permissions")
+def test_put_keeps_the_file_mode(tmp_path):
+    repository = LocalDiagramRepository(tmp_path)
+    repository._put("new", b"<mxGraphModel/>")
+    path = tmp_path / "new.xml"
+    assert path.stat().st_mode & 0o777 == 0o666 & ~storage._UMASK
+
+    path.chmod(0o640)
+    repository._put("new", b"<mxGraphModel/>")
+    assert path.stat().st_mode & 0o777 == 0o640